@@ -1,41 +1,39 @@
 import os
-from random import randrange
-from PIL import Image, ImageDraw
+import sys
+import numpy
+from PIL import Image
+from deepsix import synthetic
 
 number = 1000
-directory = 'images/black'
-if not os.path.exists(os.path.join(directory, 'raw')):
-    os.makedirs(os.path.join(directory, 'raw'))
-if not os.path.exists(os.path.join(directory, 'square')):
-    os.makedirs(os.path.join(directory, 'square'))
 
-print('Creating black-and-white images...')
-for i in range(1, number + 1):
-    img = Image.new('RGB', [64, 64], color=(0, 0, 0))
-    img.save(os.path.join(directory, 'raw', '{}.bmp'.format(i)), 'BMP')
-    draw = ImageDraw.Draw(img)
-    size = 16
-    x, y = randrange(img.size[0] - size), randrange(img.size[1] - size)
-    square = [x, y, x + size, y + size]
-    draw.rectangle(square, fill=(255, 255, 255))
-    del draw
-    img.save(os.path.join(directory, 'square', '{}.bmp'.format(i)), 'BMP')
 
-print('Creating solid colour background images...')
-directory = 'images/solid'
-if not os.path.exists(os.path.join(directory, 'raw')):
-    os.makedirs(os.path.join(directory, 'raw'))
-if not os.path.exists(os.path.join(directory, 'square')):
-    os.makedirs(os.path.join(directory, 'square'))
-for i in range(number + 1, 2 * number + 1):
-    random = (randrange(255), randrange(255), randrange(255))
-    img = Image.new('RGB', [64, 64], color=random)
-    img.save(os.path.join(directory, 'raw', '{}.bmp'.format(i)), 'BMP')
-    draw = ImageDraw.Draw(img)
-    size = 16
-    x, y = randrange(img.size[0] - size), randrange(img.size[1] - size)
-    square = [x, y, x + size, y + size]
-    draw.rectangle(square, fill=(255, 255, 255))
-    del draw
-    img.save(os.path.join(directory, 'square', '{}.bmp'.format(i)), 'BMP')
-print('Done.')
+def save_images(directory, background, first, seed):
+    """Save number images plain in raw/ and with a square in square/."""
+    colours, corners, _ = synthetic.parameters(number, background=background,
+                                               seed=seed)
+    for version, label in (('raw', 0), ('square', 1)):
+        path = os.path.join(directory, version)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        labels = numpy.full(number, label, dtype=numpy.int32)
+        images = synthetic.render(colours, corners, labels)
+        for i, image in enumerate(images, first):
+            Image.fromarray(numpy.swapaxes(image, 0, 2)).save(
+                os.path.join(path, '{}.bmp'.format(i)), 'BMP')
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4):
+        # write a dataset directly, without image files
+        background = sys.argv[3] if len(sys.argv) == 4 else 'solid'
+        synthetic.save_dataset(sys.argv[1], int(sys.argv[2]),
+                               background=background)
+        exit()
+    if len(sys.argv) != 1:
+        print('Usage: python3 artificial.py '
+              '[path/to/data_dir n_images [black|solid]]')
+        exit()
+    print('Creating black-and-white images...')
+    save_images('images/black', 'black', 1, seed=0)
+    print('Creating solid colour background images...')
+    save_images('images/solid', 'solid', number + 1, seed=1)
+    print('Done.')
@@ -0,0 +1,36 @@
+import json
+import argparse
+from deepsix import benchmark
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time each stage of the pipeline on synthetic images.')
+    parser.add_argument('--directory', default='benchmark',
+                        help='scratch directory, emptied before the run')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='file to save the results to')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    parser.add_argument('--number', type=int, default=1000,
+                        help='number of synthetic images of each class')
+    parser.add_argument('--size', type=int, default=256,
+                        help='width and height of the synthetic images')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of download threads')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes')
+    parser.add_argument('--epochs', type=int, default=1,
+                        help='number of training epochs to time')
+    parser.add_argument('--stages',
+                        default='startup,download,versions,dataset,train,'
+                                'predict,ingest',
+                        help='comma-separated list of stages to run')
+    args = parser.parse_args()
+    results = benchmark.run(args.directory, number=args.number,
+                            size=args.size, workers=args.workers,
+                            processes=args.processes, epochs=args.epochs,
+                            stages=args.stages.split(','))
+    benchmark.save(results, args.output)
+    print(json.dumps(results['stages'], indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            print(benchmark.compare(json.load(f), results))
@@ -1,6 +1,10 @@
 import os
+import sys
 
-__all__ = ['images', 'data', 'experiment']
+__all__ = ['images', 'data', 'experiment', 'batches',
+           'shards', 'cache', 'benchmark', 'store', 'augment',
+           'synthetic', 'sweep', 'inference', 'cli', 'hashes', 'ingest',
+           'web']
 
 image_extensions = set(['.jpg', '.jpeg', '.bmp', '.png'])
 
@@ -13,3 +17,12 @@ def image_filenames_as_dict(input_directory):
         if ext.lower() in image_extensions:
             result[root] = os.path.join(input_directory, filename)
     return result
+
+
+def peak_memory():
+    """Return the peak resident memory in MB of this process or a child."""
+    import resource
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2.**20 if sys.platform == 'darwin' else peak / 2.**10
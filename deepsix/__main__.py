@@ -0,0 +1,4 @@
+from deepsix.cli import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import numpy
+
+
+def paste_squares(inputs, chosen, x, y, size, value):
+    """Paste squares onto some images of a batch in place.
+
+    Args:
+        inputs: An array of images of shape (n, 3, width, height).
+        chosen: A vector of the indices of the images receiving a square.
+        x, y: Vectors of the top-left corner of the square of each chosen
+            image.
+        size: The width and height of the squares.
+        value: The value of the pasted subpixels.
+    """
+    offsets = numpy.arange(size)
+    xs = x[:, None] + offsets
+    ys = y[:, None] + offsets
+    inputs[chosen[:, None, None], :, xs[:, :, None], ys[:, None, :]] = value
+
+
+class Add_Square:
+    """Paste white squares onto a random subset of a minibatch.
+
+    This is the vectorized, on-the-fly counterpart of drawing squares on a
+    copy of every image with Image_Manager.make_versions: each time a batch
+    is drawn, every image independently gets a square at a fresh random
+    position with some probability, and its label is set accordingly.
+
+    Attributes:
+        size: The width and height of the square in pixels.
+        probability: The probability that an image gets a square.
+        value: The value of the pasted subpixels, 1. for white.
+        label: The label of images with a square.
+        training_only: False, since the squares define the labels and so
+            must also be added to the validation and testing sets.
+    """
+
+    training_only = False
+
+    def __init__(self, size=16, probability=.5, value=1., label=1):
+        """Initialize the square size, probability, value, and label."""
+        self.size = size
+        self.probability = probability
+        self.value = value
+        self.label = label
+
+    def __repr__(self):
+        return 'Add_Square(size={}, probability={})'.format(self.size,
+                                                           self.probability)
+
+    def __call__(self, inputs, targets, random=numpy.random):
+        """Add squares to inputs and relabel targets in place.
+
+        Args:
+            inputs: A float array of images of shape (n, 3, width, height).
+            targets: The vector of labels of the images.
+            random: A numpy RandomState, or the numpy.random module.
+        """
+        n, _, width, height = inputs.shape
+        chosen = numpy.flatnonzero(random.random_sample(n) < self.probability)
+        # the top-left corner of each square, as chosen by add_square
+        x = random.randint(width - self.size, size=len(chosen))
+        y = random.randint(height - self.size, size=len(chosen))
+        paste_squares(inputs, chosen, x, y, self.size, self.value)
+        targets[chosen] = self.label
+
+
+class Flip:
+    """Mirror a random half of a minibatch.
+
+    Attributes:
+        horizontal: Whether images may be mirrored left to right.
+        vertical: Whether images may be mirrored top to bottom.
+        training_only: True, since flips only add variety to training.
+    """
+
+    training_only = True
+
+    def __init__(self, horizontal=True, vertical=False):
+        """Initialize the directions in which images are flipped."""
+        self.horizontal = horizontal
+        self.vertical = vertical
+
+    def __repr__(self):
+        return 'Flip(horizontal={}, vertical={})'.format(self.horizontal,
+                                                         self.vertical)
+
+    def __call__(self, inputs, targets, random=numpy.random):
+        """Flip images of shape (n, 3, width, height) in inputs in place."""
+        n = len(inputs)
+        if self.horizontal:
+            chosen = random.random_sample(n) < .5
+            inputs[chosen] = inputs[chosen, :, ::-1, :]
+        if self.vertical:
+            chosen = random.random_sample(n) < .5
+            inputs[chosen] = inputs[chosen, :, :, ::-1]
@@ -0,0 +1,212 @@
+import threading
+import collections
+import multiprocessing
+import numpy
+from .data import load_image
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def _decode_batch(task):
+    """Decode a list of image files to one uint8 array on a worker process.
+
+    Images that cannot be read or do not have the given shape are reported
+    and skipped.
+
+    Return:
+        The positions in paths of the decoded images, and their pixel data.
+    """
+    paths, shape = task
+    valid, images = [], []
+    for i, path in enumerate(paths):
+        try:
+            image = load_image(path, numpy.uint8)
+        except (IOError, OSError) as e:
+            print('Could not read {}: {}'.format(path, e))
+            continue
+        if image.shape != shape:
+            print('{} is not {}'.format(path, shape))
+            continue
+        valid.append(i)
+        images.append(image)
+    return valid, numpy.array(images, numpy.uint8).reshape((-1,) + shape)
+
+
+class Image_Stream:
+    """An iterator decoding image files into minibatches on worker processes.
+
+    Batches are decoded in parallel, a bounded number ahead of the caller, so
+    decoding overlaps the caller's work on the current batch and memory use
+    does not grow with the number of images. Each yielded batch is only
+    valid until the next one is requested.
+    """
+
+    def __init__(self, paths, batchsize, shape, processes=1, depth=None):
+        """Prepare to decode images in batches.
+
+        Args:
+            paths: A list of image file paths, decoded in order.
+            batchsize: The number of paths in each minibatch.
+            shape: The shape (3, width, height) each image must have.
+            processes: The number of worker processes decoding images.
+            depth: The maximum number of batches decoded ahead of the
+                caller; by default, two for each worker process.
+        """
+        self.paths = paths
+        self.batchsize = batchsize
+        self.shape = tuple(shape)
+        self.processes = processes
+        self.depth = depth or 2 * processes
+
+    def __iter__(self):
+        """Yield (indices, inputs) pairs for each batch.
+
+        The indices are the positions in self.paths of the images that were
+        decoded, and inputs their float32 pixel data normalized to [0,1].
+        """
+        buffer = numpy.empty((self.batchsize,) + self.shape, numpy.float32)
+        pool = multiprocessing.Pool(self.processes)
+        pending = collections.deque()
+        try:
+            for start in range(0, len(self.paths), self.batchsize):
+                task = (self.paths[start:start + self.batchsize], self.shape)
+                pending.append(
+                    (start, pool.apply_async(_decode_batch, (task,))))
+                if len(pending) >= self.depth:
+                    yield self.__ready(buffer, *pending.popleft())
+            while pending:
+                yield self.__ready(buffer, *pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __ready(self, buffer, start, result):
+        """Wait for a decoded batch and normalize it into buffer."""
+        valid, images = result.get()
+        inputs = buffer[:len(images)]
+        numpy.divide(images, 255, out=inputs, dtype=numpy.float32)
+        return start + numpy.array(valid, dtype=numpy.int64), inputs
+
+
+class Prefetcher:
+    """An iterator assembling minibatches on a background thread.
+
+    While the caller works on one minibatch, the next few are gathered from
+    the data set into a ring of preallocated buffers, which are reused for
+    the whole pass. Each yielded batch is only valid until the next one is
+    requested.
+
+    Attributes:
+        depth: The maximum number of batches prepared ahead of the caller.
+    """
+
+    def __init__(self, dataset, batchsize, depth=2, augmentations=(),
+                 seed=None):
+        """Prepare to iterate over a data set in shuffled minibatches.
+
+        Args:
+            dataset: A pair of arrays (e.g. memory-mapped .npy files) holding
+                image data and labels. The image data may instead be any
+                object with len(), shape, dtype, and take() like a numpy
+                array, and may provide a shuffled_indices() method choosing
+                the order in which images are visited.
+            batchsize: The number of images in each minibatch. Images left
+                over after the last full minibatch are skipped.
+            depth: The maximum number of batches prepared ahead, or 0 to
+                assemble each batch on the caller's thread when requested.
+            augmentations: A list of functions called in turn on each
+                normalized batch as augmentation(inputs, targets, random) to
+                alter it in place, e.g. those in deepsix.augment.
+            seed: If given, the seed of the random number generator used to
+                shuffle and augment the data (ignored by shuffled_indices),
+                so that every pass yields the same batches.
+        """
+        self.dataset = dataset
+        self.batchsize = min(batchsize, len(dataset[0]))
+        self.depth = depth
+        self.augmentations = augmentations
+        self.seed = seed
+
+    def __iter__(self):
+        """Yield (inputs, targets) minibatches in a random order."""
+        if not self.depth:
+            # assemble each batch on the caller's thread
+            for batch in self.__assemble(self.__buffers(1),
+                                         threading.Event()):
+                yield batch
+            return
+        # one buffer filling, `depth` queued, and one in use by the caller
+        buffers = self.__buffers(self.depth + 2)
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in self.__assemble(buffers, stop):
+                    batches.put(batch)
+                batches.put(None)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # unblock the producer if the caller stopped early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+    def __buffers(self, count):
+        """Return count preallocated (inputs, targets) buffer pairs."""
+        data, labels = self.dataset
+        dtype = numpy.float32 if data.dtype == numpy.uint8 else data.dtype
+        return [(numpy.empty((self.batchsize,) + data.shape[1:], dtype),
+                 numpy.empty(self.batchsize, labels.dtype))
+                for _ in range(count)]
+
+    def __assemble(self, buffers, stop):
+        """Gather shuffled minibatches into buffers, reusing them in turn."""
+        data, labels = self.dataset
+        n = len(data)
+        assert len(labels) == n
+        if self.seed is None:
+            random = numpy.random
+        else:
+            random = numpy.random.RandomState(self.seed)
+        if hasattr(data, 'shuffled_indices'):
+            indices = data.shuffled_indices()
+        else:
+            indices = numpy.arange(n)
+            random.shuffle(indices)
+        if data.dtype == numpy.uint8:
+            raw = numpy.empty((self.batchsize,) + data.shape[1:], data.dtype)
+        starts = range(0, n - self.batchsize + 1, self.batchsize)
+        for i, start_idx in enumerate(starts):
+            if stop.is_set():
+                return
+            inputs, targets = buffers[i % len(buffers)]
+            # sorted indices read memory-mapped data in file order
+            excerpt = numpy.sort(indices[start_idx:start_idx + self.batchsize])
+            if data.dtype == numpy.uint8:
+                data.take(excerpt, axis=0, out=raw, mode='clip')
+                numpy.divide(raw, 255, out=inputs, dtype=numpy.float32)
+            else:
+                data.take(excerpt, axis=0, out=inputs, mode='clip')
+            numpy.take(labels, excerpt, out=targets, mode='clip')
+            for augmentation in self.augmentations:
+                augmentation(inputs, targets, random)
+            yield inputs, targets
@@ -0,0 +1,520 @@
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import threading
+import subprocess
+import multiprocessing
+import numpy
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+from PIL import Image
+from . import peak_memory
+
+heavy_modules = ('theano', 'lasagne', 'requests', 'flickrapi')
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+
+def synthetic_images(directory, number, size=64, format='JPEG', seed=0):
+    """Write a reproducible set of synthetic images to a directory.
+
+    Like artificial.py, each image has a random solid background, and every
+    second image has a white square drawn on it. Mild noise is added so that
+    compressed formats produce files of a realistic size.
+
+    Args:
+        directory: The directory path to save the images in.
+        number: The number of images to create.
+        size: The width and height of each image.
+        format: The PIL format to save images in, e.g. 'JPEG' or 'BMP'.
+        seed: The seed of the random number generator.
+
+    Return:
+        A list of the paths of the new images.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    extension = {'JPEG': '.jpeg'}.get(format, '.' + format.lower())
+    random = numpy.random.RandomState(seed)
+    square = max(size // 4, 1)
+    paths = []
+    for i in range(number):
+        pixels = random.randint(0, 256, size=3).astype(numpy.int16)
+        pixels = pixels + random.randint(-8, 9, size=(size, size, 3))
+        if i % 2:
+            x, y = random.randint(size - square + 1, size=2)
+            pixels[y:y + square, x:x + square] = 255
+        pixels = numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+        path = os.path.join(directory, '{}{}'.format(i, extension))
+        Image.fromarray(pixels).save(path, format)
+        paths.append(path)
+    return paths
+
+
+class Local_Server(ThreadingMixIn, HTTPServer):
+    """A local HTTP server standing in for remote image hosts.
+
+    Files in a directory are served from a background thread with the
+    Content-Type guessed from their extension, so .jpeg files are served as
+    image/jpeg like the real hosts do. Requests for a file may be made to
+    fail first, to test how downloads recover.
+
+    Attributes:
+        url: The base URL of the server, without a trailing slash.
+        requests: A list of the (time, file name) of each request received.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, faults=None):
+        """Start serving the files in directory on a free local port.
+
+        Args:
+            directory: The directory of the files to serve.
+            faults: A dictionary mapping file names to a list of faults, one
+                for each of the first requests for the file: 'error' to
+                answer 500 Internal Server Error, or 'truncate' to close the
+                connection halfway through the file.
+        """
+        server = self
+        self.requests = []
+        faults = dict((name, list(x)) for name, x in (faults or {}).items())
+
+        class Handler(SimpleHTTPRequestHandler):
+
+            def translate_path(self, path):
+                path = path.split('?')[0].split('#')[0]
+                return os.path.join(directory, os.path.basename(path))
+
+            def do_GET(self):
+                name = os.path.basename(self.path.split('?')[0])
+                server.requests.append((time.time(), name))
+                fault = faults[name].pop(0) if faults.get(name) else None
+                if fault == 'error':
+                    self.send_error(500)
+                elif fault == 'truncate':
+                    with open(self.translate_path(self.path), 'rb') as f:
+                        content = f.read()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content[:len(content) // 2])
+                    self.close_connection = True
+                else:
+                    SimpleHTTPRequestHandler.do_GET(self)
+
+            def log_message(self, *args):
+                pass
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
+
+
+def directory_bytes(directory):
+    """Return the total size of the files in a directory."""
+    return sum(os.path.getsize(os.path.join(directory, x))
+               for x in os.listdir(directory))
+
+
+def _measure(queue, function, args):
+    """Run a stage, sending its timing and peak memory back to the parent."""
+    sys.stdout = open(os.devnull, 'w')  # silence per-image progress output
+    try:
+        start_time = time.time()
+        measured = function(*args)
+        elapsed_time = time.time() - start_time
+        images, n_bytes = measured[:2]
+        extra = measured[2] if len(measured) > 2 else {}
+        elapsed_time = extra.get('seconds', elapsed_time)
+        result = {'images': images,
+                  'megabytes': n_bytes / 2.**20,
+                  'seconds': elapsed_time,
+                  'images_per_second': images / elapsed_time,
+                  'megabytes_per_second': n_bytes / 2.**20 / elapsed_time,
+                  'peak_memory_megabytes': peak_memory()}
+        result.update(extra)
+        queue.put(result)
+    except ImportError as e:
+        queue.put({'skipped': str(e)})
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def run_stage(function, *args):
+    """Run function(*args) in a fresh process and measure it.
+
+    The function must return the number of images and bytes it processed,
+    and may also return a dictionary of further measurements. If that
+    dictionary has a 'seconds' entry, the throughput is computed from it
+    instead of from the time taken by the whole function, e.g. to leave
+    out setup that is timed separately. Running each stage in its own
+    process keeps the peak memory of one stage from hiding that of the
+    next.
+
+    Return:
+        A dictionary of throughput and peak memory measurements, or of the
+        error that stopped the stage, including the stage process exiting
+        without a result.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(queue, function, args))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                # a result may have arrived just before the process exited
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    result = {'error': 'Stage process exited with code {}'
+                                       ''.format(process.exitcode)}
+                break
+    process.join()
+    return result
+
+
+def bench_startup(arguments):
+    """Run the deepsix command in a fresh interpreter and time it.
+
+    Commands that do not train or download should start without importing
+    any of heavy_modules; this records which of them were imported anyway.
+
+    Return:
+        A dictionary of the elapsed seconds and the heavy modules imported.
+    """
+    code = '\n'.join([
+        'import sys, runpy',
+        'sys.argv = {!r}'.format(['deepsix'] + list(arguments)),
+        'try:',
+        '    runpy.run_module("deepsix", run_name="__main__",'
+        ' alter_sys=True)',
+        'except SystemExit:',
+        '    pass',
+        'sys.stderr.write("\\n" + " ".join(x for x in {!r}'
+        ' if x in sys.modules))'.format(heavy_modules)])
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start_time = time.time()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=root,
+                               stdout=open(os.devnull, 'w'),
+                               stderr=subprocess.PIPE)
+    _, errors = process.communicate()
+    elapsed_time = time.time() - start_time
+    return {'seconds': elapsed_time,
+            'heavy_modules': errors.decode().split('\n')[-1].split()}
+
+
+def bench_download(directory, url, number, workers):
+    """Download number images from url with Image_Manager.download_all."""
+    from .images import Image_Manager
+    manager = Image_Manager(directory)
+    for i in range(number):
+        manager.resources.add(manager.Image_Resource(
+            id=str(i), url='{}/{}.jpeg'.format(url, i)))
+    manager.download_all(workers=workers, checkpoint=None)
+    manager.save()
+    return number, directory_bytes(os.path.join(directory, 'raw'))
+
+
+def bench_versions(directory, size, processes, fast=False):
+    """Resize the downloaded images with Image_Manager.resize_raws."""
+    from .images import Image_Manager
+    manager = Image_Manager(directory)
+    n_bytes = directory_bytes(os.path.join(directory, 'raw'))
+    manager.resize_raws(size, processes=processes, fast=fast)
+    return len(manager.resources), n_bytes
+
+
+def psnr(a, b):
+    """Return the peak signal-to-noise ratio in dB of two uint8 images."""
+    error = numpy.mean((numpy.asarray(a, dtype=numpy.float64) -
+                        numpy.asarray(b, dtype=numpy.float64)) ** 2)
+    if error == 0:
+        return float('inf')
+    return 10 * numpy.log10(255. ** 2 / error)
+
+
+def compare_versions(a, b):
+    """Return the mean and minimum PSNR of the same images in a and b."""
+    values = []
+    for filename in sorted(os.listdir(a)):
+        if os.path.exists(os.path.join(b, filename)):
+            values.append(psnr(Image.open(os.path.join(a, filename)),
+                               Image.open(os.path.join(b, filename))))
+    if not values:
+        return {}
+    return {'mean_psnr': float(numpy.mean(numpy.minimum(values, 100))),
+            'min_psnr': float(numpy.min(values))}
+
+
+def bench_dataset(directory, sources, processes):
+    """Build a dataset from sources with Dataset.load_images and save."""
+    from .data import Dataset
+    dataset = Dataset(directory, sources)
+    dataset.load_images(processes=processes)
+    dataset.save()
+    return (len(dataset),
+            sum(directory_bytes(source) for source in sources))
+
+
+def bench_ingest(directory, url, number, workers, threads):
+    """Download images from url straight into a Shard_Store at 64x64.
+
+    As in the download, versions, and dataset stages together, each image
+    is resized, half of them are given a square, and all are stored as
+    arrays, but no intermediate file is written.
+    """
+    from .images import Image_Manager, add_square
+    from .shards import Shard_Store
+    from .ingest import Ingest_Pipeline
+    manager = Image_Manager(os.path.join(directory, 'images'))
+    for i in range(number):
+        manager.resources.add(manager.Image_Resource(
+            id=str(i), url='{}/{}.jpeg'.format(url, i)))
+    store = Shard_Store(os.path.join(directory, 'data'))
+    pipeline = Ingest_Pipeline(manager, store, 64,
+                               versions=[('square', add_square)])
+    n = pipeline.run(workers=workers, threads=threads, checkpoint=None)
+    manager.save()
+    return n, sum(os.path.getsize(store.shard_path(i))
+                  for i in range(store.shards))
+
+
+def network(input_var=None):
+    """Return the small network trained by bench_train."""
+    import lasagne
+    network = lasagne.layers.InputLayer(shape=(None, 3, 64, 64),
+                                        input_var=input_var)
+    network = lasagne.layers.Conv2DLayer(
+        network, num_filters=8, filter_size=(5, 5),
+        nonlinearity=lasagne.nonlinearities.leaky_rectify)
+    network = lasagne.layers.MaxPool2DLayer(network, pool_size=(2, 2))
+    return lasagne.layers.DenseLayer(
+        network, num_units=2,
+        nonlinearity=lasagne.nonlinearities.softmax)
+
+
+def bench_train(data, directory, epochs):
+    """Train a small network for a number of epochs with Experiment.
+
+    Only training is timed for the throughput; loading the data and
+    compiling the network are reported separately as setup_seconds.
+    """
+    start_time = time.time()
+    from .experiment import Experiment
+    experiment = Experiment(data=data, directory=directory, network=network)
+    setup_time = time.time() - start_time
+    start_time = time.time()
+    experiment.train(epochs)
+    elapsed_time = time.time() - start_time
+    experiment.save()
+    n = experiment.report['images_training'] * epochs
+    return n, n * 3 * 64 * 64 * 4, {
+        'seconds': elapsed_time, 'setup_seconds': setup_time,
+        'compile_cache': experiment.report.get('compile_cache')}
+
+
+def bench_predict(directory, sources, processes, engine):
+    """Score images with the network trained by bench_train.
+
+    Only scoring is timed for the throughput; importing the engine and
+    loading or compiling the network are reported separately as
+    setup_seconds.
+
+    Args:
+        directory: The output directory of bench_train.
+        sources: A list of directory paths containing images.
+        processes: The number of worker processes decoding images.
+        engine: 'theano' to use Experiment.predict, or 'numpy' to use
+            deepsix.inference without importing Theano.
+    """
+    filename = os.path.join(directory, 'predictions_{}.npy'.format(engine))
+    start_time = time.time()
+    if engine == 'numpy':
+        from .inference import Inference_Network
+        model = Inference_Network.load(
+            os.path.join(directory, 'network.json'),
+            os.path.join(directory, 'learned_parameters.npy'))
+        setup_time = time.time() - start_time
+        start_time = time.time()
+        n = model.predict_directories(sources, filename, processes=processes)
+    else:
+        from .experiment import Experiment
+        experiment = Experiment(data=None, directory=directory,
+                                network=network)
+        experiment.load_parameters()
+        setup_time = time.time() - start_time
+        start_time = time.time()
+        experiment.predict(sources, filename, processes=processes)
+        n = experiment.report['images_predicted']
+    elapsed_time = time.time() - start_time
+    return n, sum(directory_bytes(source) for source in sources), {
+        'seconds': elapsed_time, 'setup_seconds': setup_time}
+
+
+def run(directory, number=1000, size=64, workers=8, processes=None,
+        epochs=1, stages=('startup', 'download', 'versions', 'dataset',
+                          'train', 'predict', 'ingest')):
+    """Run the benchmark stages on synthetic data in a scratch directory.
+
+    Args:
+        directory: A scratch directory path, emptied before the run. An
+            existing directory is only emptied if it is empty or was made
+            by an earlier run, which leaves a marker file in it.
+        number: The number of synthetic images of each class.
+        size: The width and height of the synthetic source images.
+        workers: The number of download threads.
+        processes: The number of worker processes for CPU-bound stages;
+            by default, one for each core.
+        epochs: The number of training epochs to time.
+        stages: The names of the stages to run. The versions stage also
+            resizes a copy of the images with fast JPEG decoding, and
+            records how closely the two sets of resized images agree. The
+            ingest stage does the work of the download, versions, and
+            dataset stages in one pass without intermediate files.
+
+    Return:
+        A dictionary describing the machine and commit, and the
+        measurements of each stage.
+
+    Raise:
+        ValueError: If directory holds files not made by the benchmark.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    marker = os.path.join(directory, '.deepsix-benchmark')
+    if os.path.exists(directory):
+        if os.listdir(directory) and not os.path.exists(marker):
+            raise ValueError('{} is not a benchmark directory; refusing to '
+                             'delete it.'.format(directory))
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    open(marker, 'w').close()
+    source = os.path.join(directory, 'source')
+    synthetic_images(source, 2 * number, size)
+    images = os.path.join(directory, 'images')
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    results = {'commit': commit,
+               'python': platform.python_version(),
+               'machine': platform.platform(),
+               'cpus': multiprocessing.cpu_count(),
+               'parameters': {'number': number, 'size': size,
+                              'workers': workers, 'processes': processes,
+                              'epochs': epochs},
+               'stages': {}}
+    if 'download' in stages:
+        server = Local_Server(source)
+        results['stages']['download'] = run_stage(
+            bench_download, images, server.url, 2 * number, workers)
+        server.close()
+    else:
+        shutil.copytree(source, os.path.join(images, 'raw'))
+    if 'versions' in stages:
+        fast = os.path.join(directory, 'images_fast')
+        shutil.copytree(source, os.path.join(fast, 'raw'))
+        results['stages']['versions'] = run_stage(
+            bench_versions, images, 64, processes)
+        results['stages']['versions_fast'] = run_stage(
+            bench_versions, fast, 64, processes, True)
+        if 'images' in results['stages']['versions_fast']:
+            results['stages']['versions_fast'].update(compare_versions(
+                os.path.join(images, '64'), os.path.join(fast, '64')))
+    # split the synthetic classes into two sources for the dataset
+    sources = [os.path.join(directory, 'plain'),
+               os.path.join(directory, 'square')]
+    for path in sources:
+        os.makedirs(path)
+    for filename in os.listdir(source):
+        i = int(os.path.splitext(filename)[0])
+        Image.open(os.path.join(source, filename)).resize((64, 64)).save(
+            os.path.join(sources[i % 2], '{}.bmp'.format(i)), 'BMP')
+    if 'startup' in stages:
+        results['stages']['startup'] = {
+            'help': bench_startup(['--help']),
+            'dataset': bench_startup(
+                ['dataset', os.path.join(directory, 'startup')] + sources +
+                ['--processes', str(processes)])}
+    data = os.path.join(directory, 'data')
+    if 'dataset' in stages or 'train' in stages:
+        results['stages']['dataset'] = run_stage(
+            bench_dataset, data, sources, processes)
+    experiment = os.path.join(directory, 'experiment')
+    if 'train' in stages or 'predict' in stages:
+        results['stages']['train'] = run_stage(bench_train, data, experiment,
+                                               epochs)
+    if 'predict' in stages and 'images' in results['stages']['train']:
+        for engine in ('theano', 'numpy'):
+            results['stages']['predict_' + engine] = run_stage(
+                bench_predict, experiment, sources, processes, engine)
+        if all('images' in results['stages']['predict_' + x]
+               for x in ('theano', 'numpy')):
+            # the engines should agree up to rounding
+            results['stages']['predict_numpy']['max_difference'] = float(
+                numpy.nanmax(numpy.abs(
+                    numpy.load(os.path.join(experiment,
+                                            'predictions_theano.npy')) -
+                    numpy.load(os.path.join(experiment,
+                                            'predictions_numpy.npy')))))
+    if 'ingest' in stages:
+        server = Local_Server(source)
+        results['stages']['ingest'] = run_stage(
+            bench_ingest, os.path.join(directory, 'ingest'), server.url,
+            2 * number, workers, processes)
+        server.close()
+    return results
+
+
+def compare(old, new):
+    """Return a table comparing the throughput of two benchmark results."""
+    lines = ['{:14} {:>12} {:>12} {:>8}'.format('stage', 'old img/s',
+                                                 'new img/s', 'change')]
+    for stage in sorted(new['stages']):
+        a = old['stages'].get(stage, {}).get('images_per_second')
+        b = new['stages'][stage].get('images_per_second')
+        if a and b:
+            lines.append('{:14} {:>12.1f} {:>12.1f} {:>+8.1%}'
+                         ''.format(stage, a, b, b / a - 1))
+    for command in sorted(new['stages'].get('startup', {})):
+        a = old['stages'].get('startup', {}).get(command, {}).get('seconds')
+        b = new['stages']['startup'][command]['seconds']
+        if a and b:
+            lines.append('{:14} {:>11.2f}s {:>11.2f}s {:>+8.1%}'
+                         ''.format('start ' + command, a, b, b / a - 1))
+        heavy = new['stages']['startup'][command].get('heavy_modules')
+        if heavy:
+            lines.append('{:14} imports {}'.format('start ' + command,
+                                                   ', '.join(heavy)))
+    return '\n'.join(lines)
+
+
+def save(results, filename):
+    """Save benchmark results to a JSON file."""
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,81 @@
+import os
+import hashlib
+import numpy
+
+
+class Image_Cache:
+    """A persistent cache of decoded image pixel data.
+
+    Each entry is a .npy file holding the raw uint8 pixel data of one image,
+    keyed by the image's path, size, and modification time, so an image that
+    changes on disk is decoded again. The cache may be shared by several
+    datasets and by several worker processes at once. Reading an entry marks
+    it as recently used, and evict() removes the least recently used entries.
+
+    Attributes:
+        directory: A directory path for the cached arrays.
+        max_bytes: The total size in bytes the cache is evicted down to.
+    """
+
+    def __init__(self, directory, max_bytes=2**32):
+        """Initialize the cache in directory, creating it if necessary."""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def filename(self, path):
+        """Return the path of the cache entry for the image at path."""
+        stat = os.stat(path)
+        key = '{}|{}|{!r}'.format(os.path.abspath(path), stat.st_size,
+                                  stat.st_mtime)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def get(self, path):
+        """Return the cached pixel data of the image at path, or None."""
+        filename = self.filename(path)
+        try:
+            image = numpy.load(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        os.utime(filename, None)  # mark as recently used
+        return image
+
+    def put(self, path, image):
+        """Store the pixel data of the image at path."""
+        filename = self.filename(path)
+        subdirectory = os.path.dirname(filename)
+        if not os.path.exists(subdirectory):
+            try:
+                os.makedirs(subdirectory)
+            except OSError:
+                pass  # created by another process in the meantime
+        # write to a temporary file so readers never see a partial entry
+        partial = '{}.{}.part'.format(filename, os.getpid())
+        with open(partial, 'wb') as f:
+            numpy.save(f, image)
+        os.rename(partial, filename)
+
+    def evict(self):
+        """Remove least recently used entries until within self.max_bytes.
+
+        Return:
+            The number of entries removed.
+        """
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                filename = os.path.join(root, filename)
+                stat = os.stat(filename)
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        total = sum(x[1] for x in entries)
+        removed = 0
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(filename)
+            total -= size
+            removed += 1
+        return removed
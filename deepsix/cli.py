@@ -0,0 +1,294 @@
+"""The deepsix command, run as `python -m deepsix <command>`.
+
+Only argparse is imported when the command starts. Each subcommand imports
+the parts of deepsix it needs, and with them heavy libraries such as Theano
+or requests, when it runs, so that e.g. `deepsix dataset` or `--help` never
+pay for Theano.
+"""
+import os
+import sys
+import argparse
+import importlib
+import multiprocessing
+
+default_cache = os.path.join(os.path.expanduser('~'), '.cache', 'deepsix')
+
+
+def load_network(name):
+    """Return the network function named 'module:function'."""
+    module, _, function = name.partition(':')
+    if '' not in sys.path:
+        sys.path.insert(0, '')  # find scripts like runexperiment.py
+    return getattr(importlib.import_module(module), function or 'network')
+
+
+def find_resources(args):
+    """Return the image manager of a download or ingest, and its resources.
+
+    Return:
+        A pair of an Image_Manager and either a generator of the resources
+        discovered on Flickr, or None for the pending resources.
+    """
+    from .images import Image_Manager, Flickr_Manager, Target_Manager
+    if args.source == 'flickr':
+        manager = Flickr_Manager(api_key=args.api_key,
+                                 directory=args.directory)
+        return manager, manager.discover(
+            queries=[{'tags': tag} for tag in args.tags.split(',')],
+            maximum=args.maximum)
+    if args.source == 'target':
+        manager = Target_Manager(directory=args.directory)
+        manager.add_resources(maximum=args.maximum, filename=args.skus,
+                              size=args.size)
+        return manager, None
+    return Image_Manager(directory=args.directory), None
+
+
+def download(args):
+    """Find and download images from Flickr or Target, or resume."""
+    options = {'workers': args.workers, 'rate_limit': args.rate_limit,
+               'deduplicate': args.deduplicate}
+    manager, resources = find_resources(args)
+    if resources is None:
+        manager.download_all(**options)
+    else:
+        manager.download(resources, **options)
+    manager.save()
+
+
+def ingest(args):
+    """Download images and add them straight to a sharded dataset."""
+    from .images import add_square
+    from .shards import Shard_Store
+    from .ingest import Ingest_Pipeline
+    manager, resources = find_resources(args)
+    if resources is None:
+        pending = set(row[0] for row in manager.store.rows('pending'))
+        resources = [r for r in manager.resources
+                     if r.id in pending or r.raw]
+    store = Shard_Store(args.output, dtype=args.dtype)
+    pipeline = Ingest_Pipeline(
+        manager, store, size=args.size,
+        versions=[('square', add_square)] if args.square else [],
+        keep=args.keep, fast=args.fast)
+    pipeline.run(resources, workers=args.workers, threads=args.threads,
+                 rate_limit=args.rate_limit)
+    manager.save()
+    print(store)
+
+
+def versions(args):
+    """Resize downloaded images, and optionally add squares to them."""
+    from .images import Image_Manager, add_square
+    processes = args.processes or multiprocessing.cpu_count()
+    manager = Image_Manager(directory=args.directory)
+    manager.resize_raws(args.size, processes=processes, fast=args.fast,
+                        format=args.format, quality=args.quality)
+    if args.square:
+        manager.make_versions('square', add_square, processes=processes)
+    manager.save()
+
+
+def dataset(args):
+    """Build a dataset, or append to a sharded dataset, from directories."""
+    from .cache import Image_Cache
+    processes = args.processes or multiprocessing.cpu_count()
+    cache = None
+    if args.cache:
+        cache = Image_Cache(os.path.join(default_cache, 'images'))
+    if args.shards:
+        from .shards import Shard_Store
+        store = Shard_Store(args.output, dtype=args.dtype)
+        store.append(args.sources, processes=processes, cache=cache)
+        print(store)
+        return
+    from .data import Dataset
+    data = Dataset(args.output, args.sources, dtype=args.dtype)
+    if args.deduplicate:
+        from .hashes import Hash_Index
+        hashes = Hash_Index(os.path.join(args.output, 'hashes.db'))
+        data.deduplicate(hashes, processes=processes)
+        hashes.close()
+    print(str(data) + '\n')
+    data.load_images(processes=processes, cache=cache)
+    data.save()
+
+
+def train(args):
+    """Train a network on a dataset, then test and save it."""
+    from .experiment import Experiment
+    experiment = Experiment(
+        data=args.data, directory=args.output,
+        network=load_network(args.network),
+        mmap_mode='r' if args.mmap else None,
+        learning_rate=args.learning_rate, momentum=args.momentum,
+        cache_directory=None if args.no_cache else default_cache)
+    experiment.train(epochs=args.epochs, patience=args.patience)
+    experiment.test()
+    experiment.save()
+
+
+def test(args):
+    """Test learned parameters on the testing set of a dataset."""
+    from .experiment import Experiment
+    experiment = Experiment(
+        data=args.data, directory=args.experiment,
+        network=load_network(args.network), mmap_mode='r',
+        cache_directory=None if args.no_cache else default_cache)
+    experiment.load_parameters(args.parameters)
+    experiment.test()
+
+
+def predict(args):
+    """Write the class probabilities of the images in directories."""
+    processes = args.processes or multiprocessing.cpu_count()
+    directory = os.path.dirname(os.path.abspath(args.parameters))
+    if args.numpy:
+        from .inference import Inference_Network
+        network = Inference_Network.load(
+            os.path.join(directory, 'network.json'), args.parameters)
+        network.predict_directories(args.directories, args.output,
+                                    batchsize=args.batchsize,
+                                    processes=processes)
+        return
+    from .experiment import Experiment
+    experiment = Experiment(
+        data=None, directory=directory, network=load_network(args.network),
+        cache_directory=None if args.no_cache else default_cache)
+    experiment.load_parameters(args.parameters)
+    experiment.predict(args.directories, args.output,
+                       batchsize=args.batchsize, processes=processes)
+
+
+def parser():
+    """Return the argument parser of the deepsix command."""
+    parser = argparse.ArgumentParser(
+        prog='deepsix',
+        description='Collect images, build datasets, and train networks.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    for name, function in (('download', download), ('ingest', ingest)):
+        command = commands.add_parser(name, help=function.__doc__)
+        command.add_argument('source',
+                             choices=['flickr', 'target', 'pending'],
+                             help='where to find new images; pending '
+                                  'resumes the downloads already in the '
+                                  'directory')
+        command.add_argument('directory', help='image resource directory')
+        if name == 'ingest':
+            command.add_argument('output', help='sharded dataset directory')
+        command.add_argument('--api-key', default='api_flickr.txt',
+                             help='file with a Flickr API key and secret')
+        command.add_argument('--tags', default='',
+                             help='comma-separated Flickr tags to search for')
+        command.add_argument('--skus', default='api_target_skus.txt',
+                             help='file with one Target SKU per line')
+        command.add_argument('--size', type=int, default=64,
+                             help='size of the Target images' if
+                                  name == 'download' else
+                                  'width and height of the resized images')
+        command.add_argument('--maximum', type=int, default=5000,
+                             help='maximum number of new images per query')
+        command.add_argument('--workers', type=int, default=16,
+                             help='number of download threads')
+        command.add_argument('--rate-limit', type=float, default=20,
+                             help='maximum requests per second to each host')
+        if name == 'download':
+            command.add_argument('--deduplicate', action='store_true',
+                                 help='discard images identical to one in '
+                                      'raw/')
+        else:
+            command.add_argument('--threads', type=int, default=4,
+                                 help='number of image processing threads')
+            command.add_argument('--square', action='store_true',
+                                 help='also add images with a square, as a '
+                                      'second label')
+            command.add_argument('--fast', action='store_true',
+                                 help='decode JPEG images at a reduced scale')
+            command.add_argument('--keep', action='store_true',
+                                 help='also save the raw, resized, and '
+                                      'altered images')
+            command.add_argument('--dtype', choices=['float32', 'uint8'],
+                                 default='float32',
+                                 help='type of the pixel data')
+        command.set_defaults(function=function)
+
+    command = commands.add_parser('versions', help=versions.__doc__)
+    command.add_argument('directory', help='image resource directory')
+    command.add_argument('--size', type=int, default=64,
+                         help='width and height of the resized images')
+    command.add_argument('--square', action='store_true',
+                         help='also save a copy of each image with a square')
+    command.add_argument('--fast', action='store_true',
+                         help='decode JPEG images at a reduced scale')
+    command.add_argument('--format', choices=['BMP', 'JPEG', 'PNG'],
+                         default='BMP', help='file format of resized images')
+    command.add_argument('--quality', type=int,
+                         help='JPEG quality of the resized images')
+    command.add_argument('--processes', type=int,
+                         help='number of worker processes')
+    command.set_defaults(function=versions)
+
+    command = commands.add_parser('dataset', help=dataset.__doc__)
+    command.add_argument('output', help='dataset directory')
+    command.add_argument('sources', nargs='+',
+                         help='image directories, one for each label')
+    command.add_argument('--dtype', choices=['float32', 'uint8'],
+                         default='float32', help='type of the pixel data')
+    command.add_argument('--shards', action='store_true',
+                         help='append to a sharded dataset')
+    command.add_argument('--deduplicate', action='store_true',
+                         help='drop duplicate and near-duplicate images')
+    command.add_argument('--cache', action='store_true',
+                         help='cache decoded images in ~/.cache/deepsix')
+    command.add_argument('--processes', type=int,
+                         help='number of worker processes')
+    command.set_defaults(function=dataset)
+
+    for name, function in (('train', train), ('test', test),
+                           ('predict', predict)):
+        command = commands.add_parser(name, help=function.__doc__)
+        if name == 'train':
+            command.add_argument('data', help='dataset directory')
+            command.add_argument('output', help='experiment directory')
+            command.add_argument('--epochs', type=int, default=10)
+            command.add_argument('--patience', type=int,
+                                 help='stop after this many epochs without '
+                                      'improvement')
+            command.add_argument('--learning-rate', type=float, default=.001)
+            command.add_argument('--momentum', type=float, default=.1)
+            command.add_argument('--mmap', action='store_true',
+                                 help='memory-map the image data')
+        elif name == 'test':
+            command.add_argument('data', help='dataset directory')
+            command.add_argument('experiment', help='experiment directory')
+            command.add_argument('--parameters',
+                                 help='learned parameters .npy file')
+        else:
+            command.add_argument('parameters',
+                                 help='learned parameters .npy file')
+            command.add_argument('output', help='output .csv or .npy file')
+            command.add_argument('directories', nargs='+',
+                                 help='directories of images to score')
+            command.add_argument('--numpy', action='store_true',
+                                 help='score with NumPy instead of Theano')
+            command.add_argument('--batchsize', type=int, default=1000,
+                                 help='number of images scored at once')
+            command.add_argument('--processes', type=int,
+                                 help='number of worker processes')
+        command.add_argument('--network', default='runexperiment:network',
+                             help='network function as module:function')
+        command.add_argument('--no-cache', action='store_true',
+                             help='do not cache the compiled model')
+        command.set_defaults(function=function)
+    return parser
+
+
+def main(argv=None):
+    """Run the deepsix command with the given arguments."""
+    command_parser = parser()
+    args = command_parser.parse_args(argv)
+    if getattr(args, 'quality', None) is not None and args.format != 'JPEG':
+        command_parser.error('--quality requires --format JPEG')
+    args.function(args)
@@ -1,55 +1,175 @@
 import os
 import json
 import random
+import collections
+import multiprocessing
 import numpy
 from PIL import Image
 from . import image_filenames_as_dict
 
 
+def image_array(img):
+    """Return the RGB subpixels of a PIL.Image as a uint8 numpy array.
+
+    The array has shape (3, width, height), as for load_image.
+    """
+    return numpy.swapaxes(numpy.array(img.convert('RGB')), 2, 0)
+
+
+def load_image(path, dtype=numpy.float32, cache=None):
+    """Return the RGB pixel data of an image file as a numpy array.
+
+    The array has shape (3, width, height). If dtype is uint8, it holds the
+    raw subpixel values; otherwise they are normalized to the interval [0,1].
+    If an Image_Cache is given, the image is only decoded if it is not
+    already in the cache.
+    """
+    image = cache.get(path) if cache else None
+    if image is None:
+        image = image_array(Image.open(path))
+        if cache:
+            cache.put(path, image)
+    if dtype == numpy.uint8:
+        return image
+    image = image / 255.
+    return image.astype(dtype)
+
+
+def image_shape(path):
+    """Return the shape of load_image(path), reading only the file header."""
+    width, height = Image.open(path).size
+    return (3, width, height)
+
+
+_outputs = {}
+
+
+def load_into(task):
+    """Decode the image at path into row index of the .npy file filename.
+
+    The task is a (filename, index, path, cache) tuple, so that a pool of
+    worker processes can map it over many images. Each process opens each
+    output file once, as a writable memory map.
+
+    Return:
+        Whether the image was found in the cache.
+    """
+    filename, index, path, cache = task
+    if filename not in _outputs:
+        _outputs[filename] = numpy.load(filename, mmap_mode='r+')
+    output = _outputs[filename]
+    hit = bool(cache) and os.path.exists(cache.filename(path))
+    output[index] = load_image(path, output.dtype, cache)
+    return hit
+
+
+purposes = ('training', 'validation', 'testing')
+
+
+class Path_Table:
+    """An immutable table of file paths packed into a single buffer.
+
+    The UTF-8 encoded paths are stored back to back in one numpy byte array
+    with a second array of offsets, so that millions of paths take little
+    more memory than their characters and can be reordered without creating
+    a Python object for each one.
+    """
+
+    def __init__(self, paths=(), buffer=None, offsets=None):
+        """Pack a list of paths, or wrap an existing buffer and offsets."""
+        if buffer is None:
+            encoded = [path.encode('utf-8') for path in paths]
+            offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(x) for x in encoded], out=offsets[1:])
+            buffer = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+        self.__buffer = buffer
+        self.__offsets = offsets
+
+    def __len__(self):
+        """Return the number of paths in the table."""
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, index):
+        """Return the path at an integer index."""
+        start, end = self.__offsets[index], self.__offsets[index + 1]
+        return self.__buffer[start:end].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        """Iterate over the paths in order."""
+        for index in range(len(self)):
+            yield self[index]
+
+    def take(self, indices):
+        """Return a new Path_Table of the paths at an array of indices."""
+        starts = self.__offsets[:-1][indices]
+        lengths = self.__offsets[1:][indices] - starts
+        offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=offsets[1:])
+        # position of each output byte in the old buffer
+        gather = (numpy.arange(offsets[-1], dtype=numpy.int64) +
+                  numpy.repeat(starts - offsets[:-1], lengths))
+        return Path_Table(buffer=self.__buffer[gather], offsets=offsets)
+
+
 class Dataset:
     """A class for converting folders of images to numpy arrays with labels.
 
+    The images are indexed by parallel columns rather than one object each:
+    entry i of paths, labels, and split describes the same image.
+
     Attributes:
         directory: A directory path for for the output files.
         sources: A list of paths to directories containing images to be used.
-        images: A list of Image_Data each storing the path, source index, and
-            a numpy array of the image data.
-        parts: A dictionary storing the number of images reserved for the
-            training, validation, and testing data sets.
+        dtype: The name of the numpy type used to store pixel data: 'float32'
+            for values in [0,1] or 'uint8' for raw values in [0,255].
+        paths: A Path_Table storing the local path of each image.
+        labels: A numpy int32 vector storing the source index of each image.
+        split: A numpy int8 vector storing the position in purposes of the
+            training, validation, or testing set each image belongs to.
+        data: A dictionary storing a memory-mapped numpy array of the pixel
+            data of the training, validation, and testing sets, filled in by
+            load_images().
     """
 
-    def __init__(self, directory, sources):
+    def __init__(self, directory, sources, dtype='float32'):
         """Initialize the dataset with image paths.
 
         Args:
             directory: A directory path for for the output files.
             sources: A list of directory paths containing images.
+            dtype: 'float32' to store pixel data normalized to [0,1], or
+                'uint8' to store raw values in a quarter of the space.
         """
+        if dtype not in ('float32', 'uint8'):
+            raise ValueError('Unsupported dtype {}.'.format(dtype))
         if not os.path.exists(directory):
             os.makedirs(directory)
         self.directory = directory
         self.sources = sources
+        self.dtype = dtype
         self.load_paths()
         self.repartition()
-        n = len(self.images)
-        self.parts = {'training': slice(2*(n//10), n),
-                      'validation': slice(n//10, 2*(n//10)),
-                      'testing': slice(n//10)}
+
+    def __len__(self):
+        """Return the number of images in the dataset."""
+        return len(self.labels)
 
     def __str__(self):
         """Return a summary of the dataset."""
-        result = '{} images from {} sources'.format(len(self.images),
+        result = '{} images from {} sources'.format(len(self),
                                                     len(self.sources))
-        for purpose in ['training', 'validation', 'testing']:
-            dist = []
-            images = self.images[self.parts[purpose]]
-            for source in range(len(self.sources)):
-                dist.append(sum(1 for x in images if x.label == source))
+        # count images by (split, label) pair in a single pass
+        counts = numpy.bincount(
+            self.split.astype(numpy.int64) * len(self.sources) + self.labels,
+            minlength=len(purposes) * len(self.sources))
+        counts = counts.reshape(len(purposes), len(self.sources))
+        for k, purpose in enumerate(purposes):
+            dist = counts[k].tolist()
             result += '\n | {:6} for {} {}'.format(sum(dist), purpose, dist)
         return result
 
     def load_paths(self):
-        """Add Image_Data to self.images for each image in self.sources.
+        """Index the paths and labels of each image in self.sources.
 
         If two sources contain an image with the same id, choose one source
         uniformly at random.
@@ -65,82 +185,138 @@ class Dataset:
                     path_dictionary[uid].append((path, label))
             label += 1
         # roll a die to decide which source to use for each image id
-        for uid, paths in path_dictionary.items():
-            source = random.randrange(len(paths))
-            path_dictionary[uid] = paths[source]
-        # add (path, label) pairs to self.paths
-        self.images = []
-        for item in path_dictionary.values():
-            self.images.append(self.Image_Data(path=item[0],
-                                               label=item[1]))
+        paths = []
+        labels = []
+        for uid, items in path_dictionary.items():
+            path, label = items[random.randrange(len(items))]
+            paths.append(path)
+            labels.append(label)
+        self.paths = Path_Table(paths)
+        self.labels = numpy.array(labels, dtype=numpy.int32)
+        self.__set_parts()
 
     def repartition(self):
         """Redistribute images among the training/validation/testing sets."""
-        random.shuffle(self.images)
-
-    def load_images(self):
-        """Load image data from paths for all images in self.images."""
-        correct_shape = None
-        for image in self.images:
-            image.load()
-            if correct_shape:
-                try:
-                    assert image.image.shape == correct_shape
-                    correct_shape = image.image.shape
-                except AssertionError:
-                    print('{} is not {}'.format(image.path, correct_shape))
+        self.__select(numpy.random.permutation(len(self)))
+
+    def deduplicate(self, hashes, processes=1, perceptual=True):
+        """Drop duplicate images and repartition the remaining ones.
+
+        Exact copies (files with the same sha1) are collapsed across all
+        sources, and near-duplicates (files with the same dHash) within each
+        source, keeping one image of each group, so that no picture is both
+        trained and tested on. Flat images, whose dHash is 0, are never
+        treated as near-duplicates, nor are gradients whose dHash has every
+        bit set (-1).
+
+        Args:
+            hashes: A Hash_Index, updated with any new or changed images.
+            processes: The number of worker processes hashing images.
+            perceptual: Whether to collapse near-duplicates as well.
+        """
+        paths = list(self.paths)
+        hashes.update(paths, processes)
+        sha1, dhash = hashes.lookup(paths)
+        keep = numpy.zeros(len(self), dtype=bool)
+        keep[numpy.unique(numpy.array(sha1), return_index=True)[1]] = True
+        exact = len(self) - keep.sum()
+        if perceptual:
+            similar = keep & (dhash != 0) & (dhash != -1)
+            candidates = numpy.flatnonzero(similar)
+            keys = numpy.column_stack([self.labels[candidates],
+                                       dhash[candidates]])
+            keep[candidates] = False
+            keep[candidates[numpy.unique(keys, axis=0,
+                                         return_index=True)[1]]] = True
+        print('Dropped {} exact and {} near duplicates'.format(
+            exact, len(self) - keep.sum() - exact))
+        self.__select(numpy.flatnonzero(keep))
+        self.repartition()
+
+    def load_images(self, processes=1, cache=None):
+        """Load image data from paths for all images in self.paths.
+
+        The images are decoded in parallel and streamed straight into .npy
+        files of type self.dtype in self.directory, one for each of the
+        training, validation, and testing sets, so that only a few images are
+        ever held in memory. Images whose shape does not match the most common
+        shape are reported and dropped from the dataset.
+
+        Args:
+            processes: The number of worker processes decoding images.
+            cache: An Image_Cache of decoded images. Only images missing from
+                the cache are decoded, and the cache is then evicted down to
+                its maximum size.
+
+        Raise:
+            ValueError: If the sources contain no images.
+        """
+        if not len(self):
+            raise ValueError('No images found in {}.'.format(
+                ', '.join(self.sources)))
+        pool = multiprocessing.Pool(processes)
+        try:
+            shapes = pool.map(image_shape, self.paths, chunksize=64)
+            correct_shape = collections.Counter(shapes).most_common(1)[0][0]
+            correct = numpy.array([shape == correct_shape for shape in shapes],
+                                  dtype=bool)
+            for index in numpy.flatnonzero(~correct):
+                print('{} is not {}'.format(self.paths[index], correct_shape))
+            self.__select(numpy.flatnonzero(correct))
+            self.data = {}
+            tasks = []
+            for k, part in enumerate(purposes):
+                indices = numpy.flatnonzero(self.split == k)
+                data_file = os.path.join(self.directory, part + '_data.npy')
+                self.data[part] = numpy.lib.format.open_memmap(
+                    data_file, mode='w+', dtype=self.dtype,
+                    shape=(len(indices),) + correct_shape)
+                tasks.extend((data_file, i, self.paths[j], cache)
+                             for i, j in enumerate(indices))
+            hits = pool.map(load_into, tasks, chunksize=64)
+        finally:
+            pool.terminate()
+            pool.join()
+        if cache:
+            print('Loaded {} images, {} from the cache'.format(len(hits),
+                                                              sum(hits)))
+            cache.evict()
+
+    def __select(self, indices):
+        """Keep only the images at indices, in that order, and re-split."""
+        self.paths = self.paths.take(indices)
+        self.labels = self.labels[indices]
+        self.__set_parts()
+
+    def __set_parts(self):
+        """Reserve the first 20% of the images for validation and testing."""
+        n = len(self)
+        self.split = numpy.zeros(n, dtype=numpy.int8)
+        self.split[n//10:2*(n//10)] = purposes.index('validation')
+        self.split[:n//10] = purposes.index('testing')
 
     def save(self):
         """Save the dataset in .npy and JSON files.
 
         Six .npy files are produced, storing the image data and labels of the
-        training, validation, and testing sets, respectively. One JSON file
-        stores the list of image paths used in the dataset for better
-        reproducibility.
+        training, validation, and testing sets, respectively. The image data
+        files are written by load_images(); this method flushes them to disk.
+        One JSON file stores the list of image paths used in the dataset for
+        better reproducibility.
         """
         save_data = {}
         save_data['sources'] = self.sources
-        save_data['paths'] = [x.path for x in self.images]
-        for part, slice in self.parts.items():
-            # load data into numpy array
-            data = numpy.array([x.image for x in self.images[slice]])
-            labels = numpy.array([x.label for x in self.images[slice]])
-            # cast numpy arrays to the appropriate types
-            data = data.astype(numpy.float32)
-            labels = labels.astype(numpy.int32)
-            # save data and labels to .npy files
-            data_file = os.path.join(self.directory, part + '_data.npy')
-            numpy.save(data_file, data)
-            print('Saved array {!s:22} > {}'.format(data.shape, data_file))
+        save_data['dtype'] = self.dtype
+        save_data['paths'] = list(self.paths)
+        for k, part in enumerate(purposes):
+            data = self.data[part]
+            labels = self.labels[self.split == k]
+            # flush the image data and save labels to .npy files
+            data.flush()
+            print('Saved array {!s:22} > {}'.format(data.shape, data.filename))
             labels_file = os.path.join(self.directory, part + '_labels.npy')
             numpy.save(labels_file, labels)
             print('Saved array {!s:22} > {}'.format(labels.shape, labels_file))
         filename = os.path.join(self.directory, 'datasets.json')
         with open(filename, 'w') as f:
             json.dump(save_data, f)
-
-    class Image_Data:
-        """The local path, source label, and pixel data of an image file.
-
-        Attributes:
-            path: A string storing the local path of the image.
-            label: An integer indicating the source of the image.
-            image: A 3D numpy array storing the pixel data of the image.
-        """
-
-        def __init__(self, path, label):
-            """Initialize image path and label."""
-            self.path = path
-            self.label = label
-            self.image = []
-
-        def load(self):
-            """Load RGB image data from the file at self.path to a numpy array.
-
-            The numpy array self.image has shape (3, width, height) with
-            subpixel values normalized to the interval [0,1].
-            """
-            image = numpy.array(Image.open(self.path).convert('RGB'))
-            image = numpy.swapaxes(image, 2, 0)
-            image = image / 255.
-            self.image = image
@@ -3,11 +3,19 @@ import theano
 import theano.tensor as T
 import lasagne
 from lasagne.layers import get_output, get_all_params
+from . import peak_memory
+from .batches import Prefetcher
+from .inference import predict_images, describe
+from .shards import Shard_Store
 import time
 import os
+import sys
 import inspect
 import json
 import csv
+import hashlib
+import pickle
+import functools
 
 
 class Experiment:
@@ -18,46 +26,120 @@ class Experiment:
         validation,
         testing: Pairs, each consisting of a numpy array containing pixel data
             for many images and a numpy vector containing the labels of each
-            image.
+            image. Each pair is loaded from disk when it is first used.
         report: A dictionary of strings and parameters describing the
             experiment, including the network structure and training process.
         history: A list recording the training and validation loss and
             accuracy for each epoch in the training process.
     """
 
-    def __init__(self, data, directory, network, **kwargs):
+    def __init__(self, data, directory, network, mmap_mode=None, prefetch=2,
+                 augmentations=(), **kwargs):
         """Load datasets and compile the neural network model.
 
         Args:
-            data: The path of the directory containing the dataset .npy files.
+            data: The path of the directory containing the dataset .npy files,
+                a dictionary mapping 'training', 'validation', and 'testing'
+                to (data, labels) pairs already in memory (e.g. from
+                deepsix.synthetic.generate), or None for an experiment that
+                will only make predictions.
             directory: The directory path to save the output of the experiment.
             network: A function taking a Theano input variable and returning
                 the output layer of a Lasagne neural network.
+            mmap_mode: If not None, open the image data .npy files as
+                memory-mapped arrays in this mode (e.g. 'r') rather than
+                reading them into memory.
+            prefetch: The number of minibatches assembled ahead on a
+                background thread, or 0 to assemble them between calls to
+                the network.
+            augmentations: A list of functions altering each minibatch in
+                place, e.g. deepsix.augment.Add_Square(). All of them are
+                applied to training batches, and those with a training_only
+                attribute that is false also to validation and testing
+                batches, with a fixed seed so that every pass sees the same
+                batches.
             **kwargs: Passed to self.__compile_model.
         """
         if not os.path.exists(directory):
             os.makedirs(directory)  # Ensure `directory` exists
         self.directory = directory
+        self.prefetch = prefetch
+        self.augmentations = augmentations
         self.report = {}
+        if augmentations:
+            self.report['augmentations'] = [repr(x) for x in augmentations]
         self.history = [['Epoch',
                          'Trn_Loss', 'Trn_Prc', 'Trn_Rec', 'Trn_Acc',
-                         'Val_Loss', 'Val_Prc', 'Val_Rec', 'Val_Acc']]
+                         'Val_Loss', 'Val_Prc', 'Val_Rec', 'Val_Acc',
+                         'Time', 'Trn_Wait', 'Trn_Compute', 'Val_Time',
+                         'Img_per_s', 'Batch_per_s', 'Peak_RSS_MB']]
         self.__compile_model(network, **kwargs)
-        self.__load_data(data)
+        if isinstance(data, dict):
+            self.__data = dict(data)
+            for x in ('training', 'validation', 'testing'):
+                self.report['images_' + x] = len(self.__data[x][1])
+        elif data:
+            self.__load_data(data, mmap_mode)
+
+    @property
+    def training(self):
+        """The training data set, loaded on first use."""
+        return self.__get_data('training')
+
+    @property
+    def validation(self):
+        """The validation data set, loaded on first use."""
+        return self.__get_data('validation')
+
+    @property
+    def testing(self):
+        """The testing data set, loaded on first use."""
+        return self.__get_data('testing')
 
     def load_parameters(self, filename=None):
         """Load the learned parameters from a previous experiment."""
         if not filename:
             filename = os.path.join(self.directory, 'learned_parameters.npy')
-        params = numpy.load(filename)
+        params = numpy.load(filename, allow_pickle=True)
         lasagne.layers.set_all_param_values(self.__network, params)
 
-    def train(self, epochs):
+    def train(self, epochs, batch_callback=None, track_memory=False,
+              patience=None, metric='loss', validate_every=1,
+              validation_subsample=None):
         """Train the network, report on progress, and output test results.
 
+        Besides the loss and accuracy, the time spent waiting for training
+        data, running the training function, and validating is recorded for
+        each epoch, along with the training throughput.
+
+        The parameters with the best validation score are kept in memory, and
+        are restored to the network (and so written by save()) once training
+        ends. The epoch they come from is recorded as best_epoch in the report.
+
         Args:
-            epochs: Number of epochs to train for.
+            epochs: The maximum number of epochs to train for, possibly 0.
+            batch_callback: A function called after every minibatch as
+                batch_callback(epoch, phase, batch, wait_time, compute_time),
+                where phase is 'training' or 'validation', e.g. to find
+                unusually slow batches.
+            track_memory: If true, record the peak resident memory of the
+                process after each epoch.
+            patience: If given, stop once this many epochs have passed
+                without an improvement in the validation score. This is only
+                checked after validating, so training never stops on an
+                epoch that was not validated.
+            metric: The validation score used to choose the best parameters:
+                'loss' (lower is better), or 'precision', 'recall', or
+                'accuracy' (higher is better).
+            validate_every: Validate only every this many epochs, and after
+                the last epoch.
+            validation_subsample: If given, validate on this many images,
+                chosen at random once and reused every epoch, rather than
+                the whole validation set. At least one minibatch of 100.
         """
+        metrics = ('loss', 'precision', 'recall', 'accuracy')
+        if metric not in metrics:
+            raise ValueError('Unsupported metric {}.'.format(metric))
         print('Starting training...')
         print('\n{:13} '
               '{:>17}  '
@@ -67,26 +149,110 @@ class Experiment:
               '{:>8} {:>8}  '
               '{:>8} {:>8} {:>8} {:>8}'
               ''.format('', '', 'Loss', 'Acc', 'Loss', 'Prc', 'Rec', 'Acc'))
-        training_time = 0
+        training, validation = self.training, self.validation
+        if validation_subsample and validation_subsample < len(validation[1]):
+            indices = numpy.sort(numpy.random.choice(
+                len(validation[1]), validation_subsample, replace=False))
+            validation = (validation[0].take(indices, axis=0),
+                          validation[1][indices])
+        # the sign makes a lower score better for every metric
+        sign = 1 if metric == 'loss' else -1
+        best_score = None
+        best_epoch = None
+        best_parameters = None
+        totals = {'time': 0, 'wait': 0, 'compute': 0, 'validation': 0,
+                  'training': 0, 'images': 0, 'batches': 0}
+        epoch = 0
         for epoch in range(1, epochs + 1):
+            callbacks = {}
+            if batch_callback:
+                for phase in ('training', 'validation'):
+                    callbacks[phase] = functools.partial(batch_callback,
+                                                         epoch, phase)
             start_time = time.time()
-            trn_stats = self.__progress(self.training, self.__train_fn)
-            val_stats = self.__progress(self.validation, self.__val_fn)
-            elapsed_time = time.time() - start_time
-            training_time += elapsed_time
-            print('{:>4} {:>7.2f}s '
-                  '{:>8.3f} {:>8.1%}  '
-                  '{:>8.3f} {:>8.1%} {:>8.1%} {:>8.1%}'
-                  ''.format(epoch, elapsed_time,
-                            trn_stats[0], trn_stats[-1],
-                            *val_stats))
-            self.history.append([epoch] + list(trn_stats) + list(val_stats))
-        self.report['epochs'] = epochs
-        self.report['time_per_epoch'] = training_time / epochs
+            trn_stats = self.__progress(training, self.__train_fn,
+                                        callbacks.get('training'),
+                                        self.augmentations)
+            trn_timing = self.__timing
+            validation_start = time.time()
+            if epoch % validate_every == 0 or epoch == epochs:
+                val_stats = self.__progress(validation, self.__val_fn,
+                                            callbacks.get('validation'),
+                                            self.__evaluation_augmentations(),
+                                            seed=0)
+            else:
+                val_stats = None
+            end_time = time.time()
+            elapsed_time = end_time - start_time
+            training_time = validation_start - start_time
+            validation_time = end_time - validation_start
+            if val_stats:
+                print('{:>4} {:>7.2f}s '
+                      '{:>8.3f} {:>8.1%}  '
+                      '{:>8.3f} {:>8.1%} {:>8.1%} {:>8.1%}'
+                      ''.format(epoch, elapsed_time,
+                                trn_stats[0], trn_stats[-1],
+                                *val_stats))
+            else:
+                print('{:>4} {:>7.2f}s '
+                      '{:>8.3f} {:>8.1%}'
+                      ''.format(epoch, elapsed_time,
+                                trn_stats[0], trn_stats[-1]))
+            memory = peak_memory() if track_memory else ''
+            self.history.append([epoch] + list(trn_stats) +
+                                list(val_stats or [''] * 4) +
+                                [elapsed_time,
+                                 trn_timing['wait'],
+                                 trn_timing['compute'],
+                                 validation_time,
+                                 trn_timing['images'] / training_time,
+                                 trn_timing['batches'] / training_time,
+                                 memory])
+            totals['time'] += elapsed_time
+            totals['wait'] += trn_timing['wait']
+            totals['compute'] += trn_timing['compute']
+            totals['validation'] += validation_time
+            totals['training'] += training_time
+            totals['images'] += trn_timing['images']
+            totals['batches'] += trn_timing['batches']
+            if val_stats:
+                score = sign * val_stats[metrics.index(metric)]
+                if best_score is None or score < best_score:
+                    best_score = score
+                    best_epoch = epoch
+                    best_parameters = lasagne.layers.get_all_param_values(
+                        self.__network)
+            if (patience and val_stats and
+                    epoch - best_epoch >= patience):
+                print('No improvement in {} epochs, stopping.'
+                      ''.format(epoch - best_epoch))
+                break
+        if best_parameters is not None:
+            lasagne.layers.set_all_param_values(self.__network,
+                                                best_parameters)
+        self.report['epochs'] = epoch
+        self.report['best_epoch'] = best_epoch
+        self.report['best_validation_' + metric] = (
+            None if best_score is None else sign * best_score)
+        if epoch:
+            self.report['time_per_epoch'] = totals['time'] / epoch
+            self.report['data_wait_per_epoch'] = totals['wait'] / epoch
+            self.report['compute_per_epoch'] = totals['compute'] / epoch
+            self.report['validation_per_epoch'] = (totals['validation'] /
+                                                   epoch)
+            self.report['images_per_second'] = (totals['images'] /
+                                                totals['training'])
+            self.report['batches_per_second'] = (totals['batches'] /
+                                                 totals['training'])
+        if track_memory:
+            self.report['peak_memory_megabytes'] = peak_memory()
 
     def test(self):
         """Test the learned parameters on the testing dataset."""
-        statistics = self.__progress(self.testing, self.__val_fn)
+        statistics = self.__progress(self.testing, self.__val_fn,
+                                     augmentations=(
+                                         self.__evaluation_augmentations()),
+                                     seed=0)
         print('Loss:      {}'.format(statistics[0]))
         print('Precision: {:.3%}'.format(statistics[1]))
         print('Recall:    {:.3%}'.format(statistics[2]))
@@ -96,6 +262,32 @@ class Experiment:
         self.report['test_recall'] = statistics[2]
         self.report['test_accuracy'] = statistics[3]
 
+    def predict(self, directories, filename, batchsize=1000, processes=1):
+        """Write the predicted class probabilities of images in directories.
+
+        Images are decoded on worker processes while the network scores the
+        previous batch, and results are written as each batch completes, so
+        memory use does not depend on the number of images.
+
+        Args:
+            directories: A list of directory paths containing images.
+            filename: The output path. A .npy file receives a float32 array
+                with one row of probabilities per image (NaN for images that
+                could not be scored), and a file ending in _ids.txt next to it
+                the image ids in the same order. Any other file is written as
+                CSV with an id column followed by one column for each class.
+            batchsize: The number of images scored at once.
+            processes: The number of worker processes decoding images.
+        """
+        input_layer = lasagne.layers.get_all_layers(self.__network)[0]
+        n_classes = lasagne.layers.get_output_shape(self.__network)[1]
+        start_time = time.time()
+        scored = predict_images(self.__predict_fn, input_layer.shape[1:],
+                                n_classes, directories, filename, batchsize,
+                                processes)
+        self.report['images_predicted'] = scored
+        self.report['time_to_predict'] = time.time() - start_time
+
     def save(self):
         """Save the results of the experiment to self.directory."""
         filename = os.path.join(self.directory, 'experiment.json')
@@ -108,18 +300,45 @@ class Experiment:
         parameters = lasagne.layers.get_all_param_values(self.__network)
         parameters = parameters
         numpy.save(filename, parameters)
+        # describe the network for deepsix.inference, if it can run it
+        try:
+            description = describe(self.__network)
+        except ValueError as e:
+            print('Not saving network.json: {}'.format(e))
+            return
+        filename = os.path.join(self.directory, 'network.json')
+        with open(filename, 'w') as f:
+            json.dump(description, f, indent=2)
 
     def __compile_model(self,
                         network,
                         loss=lasagne.objectives.categorical_crossentropy,
                         learning_rate=0.001,
-                        momentum=0.1):
-        """Compile the Theano functions used in the experiment."""
-        print('Compiling model...')
+                        momentum=0.1,
+                        cache_directory=None):
+        """Compile the Theano functions used in the experiment.
+
+        If cache_directory is given, the compiled functions are pickled there
+        together with the network, keyed by a hash of the network source,
+        loss function, hyperparameters, and library versions, and later
+        experiments with the same key load them instead of compiling.
+        """
         self.report['network'] = inspect.getsource(network)
         self.report['loss_function'] = loss.__name__
         self.report['learning_rate'] = learning_rate
         self.report['learning_momentum'] = momentum
+        if cache_directory:
+            filename = os.path.join(cache_directory,
+                                    self.__cache_key() + '.pkl')
+            if self.__load_compiled(filename):
+                # draw fresh initial parameters rather than reusing the cached
+                lasagne.layers.set_all_param_values(
+                    self.__network,
+                    lasagne.layers.get_all_param_values(
+                        network(T.tensor4('inputs'))))
+                return
+            self.report['compile_cache'] = 'miss'
+        print('Compiling model...')
         start_time = time.time()
         self.__input_var = T.tensor4('inputs')
         self.__target_var = T.ivector('targets')
@@ -151,35 +370,145 @@ class Experiment:
         self.__val_fn = theano.function(
             [self.__input_var, self.__target_var],
             [self.__loss(True)] + statistics)
+        self.__predict_fn = theano.function(
+            [self.__input_var],
+            get_output(self.__network, deterministic=True))
         elapsed_time = time.time() - start_time
         self.report['time_to_compile'] = elapsed_time
+        if cache_directory:
+            self.__save_compiled(filename)
 
-    def __load_data(self, input_directory):
-        """Initialize data sets from .npy files in self.directory.
+    def __cache_key(self):
+        """Return a hash identifying the compiled functions of the model."""
+        key = [self.report[x] for x in ('network', 'loss_function',
+                                        'learning_rate', 'learning_momentum')]
+        key += [theano.__version__, lasagne.__version__, numpy.__version__,
+                theano.config.device, theano.config.floatX, sys.version]
+        key = json.dumps(key, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
 
-        Each of self.training, self.validation, and self.testing is
-        initialized as a pair: the first element a numpy array contains image
+    def __load_compiled(self, filename):
+        """Load the network and compiled functions from a cache file.
+
+        Return:
+            Whether the cache file existed and was loaded.
+        """
+        if not os.path.exists(filename):
+            return False
+        print('Loading compiled model...')
+        start_time = time.time()
+        # Theano graphs are deeply nested
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 50000))
+        try:
+            with open(filename, 'rb') as f:
+                (self.__input_var, self.__target_var, self.__network,
+                 self.__train_fn, self.__val_fn,
+                 self.__predict_fn) = pickle.load(f)
+        except Exception as e:
+            print('Could not load {}: {}'.format(filename, e))
+            return False
+        finally:
+            sys.setrecursionlimit(limit)
+        self.report['compile_cache'] = 'hit'
+        self.report['time_to_load_cache'] = time.time() - start_time
+        return True
+
+    def __save_compiled(self, filename):
+        """Pickle the network and compiled functions to a cache file.
+
+        The cache only saves time, so a failure to write it is reported and
+        otherwise ignored.
+        """
+        partial = '{}.{}.part'.format(filename, os.getpid())
+        # Theano graphs are deeply nested
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 50000))
+        try:
+            directory = os.path.dirname(filename)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(partial, 'wb') as f:
+                pickle.dump((self.__input_var, self.__target_var,
+                             self.__network, self.__train_fn, self.__val_fn,
+                             self.__predict_fn),
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.rename(partial, filename)
+        except Exception as e:
+            print('Could not save {}: {}'.format(filename, e))
+            if os.path.exists(partial):
+                os.remove(partial)
+        finally:
+            sys.setrecursionlimit(limit)
+
+    def __load_data(self, input_directory, mmap_mode=None):
+        """Prepare to load data sets from .npy files in input_directory.
+
+        Each of self.training, self.validation, and self.testing is loaded on
+        first use as a pair: the first element a numpy array contains image
         data, and the second element a numpy vector containing the label
-        corresponding to each image.
+        corresponding to each image. Only the labels are read here. Image
+        data stored as uint8 is normalized to [0,1] one minibatch at a time.
+
+        If input_directory holds a Shard_Store, the image data of each set is
+        instead a Shard_Array streaming images from the shards.
         """
         print("Loading data...")
-        self.training, self.validation, self.testing = (
-            tuple(
+        self.__data_directory = input_directory
+        self.__mmap_mode = mmap_mode
+        self.__data = {}
+        self.report['data_directory'] = input_directory
+        if os.path.exists(os.path.join(input_directory, 'manifest.csv')):
+            shards = Shard_Store(input_directory)
+            self.report['data_dtype'] = shards.dtype
+            for x in ('training', 'validation', 'testing'):
+                self.__data[x] = shards.split(x)
+                self.report['images_' + x] = len(self.__data[x][1])
+            return
+        filename = os.path.join(input_directory, 'datasets.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.report['data_dtype'] = json.load(f).get('dtype',
+                                                             'float32')
+        for x in ('training', 'validation', 'testing'):
+            labels = numpy.load(
+                os.path.join(input_directory, '{}_labels.npy'.format(x)),
+                mmap_mode='r')
+            self.report['images_' + x] = len(labels)
+
+    def __get_data(self, purpose):
+        """Return the (data, labels) pair for purpose, loading it if needed."""
+        if purpose not in self.__data:
+            self.__data[purpose] = tuple(
                 numpy.load(
-                    os.path.join(input_directory, '{}_{}.npy'.format(x, y))
+                    os.path.join(self.__data_directory,
+                                 '{}_{}.npy'.format(purpose, y)),
+                    mmap_mode=self.__mmap_mode if y == 'data' else None
                 )
                 for y in ('data', 'labels')
             )
-            for x in ('training', 'validation', 'testing')
-        )
-        self.report['data_directory'] = input_directory
-        self.report['images_training'] = len(self.training[1])
-        self.report['images_validation'] = len(self.validation[1])
-        self.report['images_testing'] = len(self.validation[1])
+        return self.__data[purpose]
+
+    def __evaluation_augmentations(self):
+        """Return the augmentations applied to validation and testing.
+
+        An augmentation without a training_only attribute, such as a plain
+        function, is treated as training only.
+        """
+        return [x for x in self.augmentations
+                if not getattr(x, 'training_only', True)]
 
-    def __progress(self, dataset, input_function):
+    def __progress(self, dataset, input_function, callback=None,
+                   augmentations=(), seed=None):
         """Train network for one epoch (one pass through all minibatches).
 
+        The minibatches are altered by augmentations and shuffled with seed
+        as described for Prefetcher. The time spent waiting for minibatches
+        and running input_function is stored in self.__timing, along with the
+        number of batches and images processed. If given,
+        callback(batch, wait_time, compute_time) is called after each
+        minibatch.
+
         Return:
             Average objective function value and accuracy.
         """
@@ -190,28 +519,44 @@ class Experiment:
         total_relevant = 0
         total_correct_relevant = 0
         total_batches = 0
-        for batch in self.__iterate_minibatches(dataset, batchsize):
+        total_images = 0
+        total_wait = 0
+        total_compute = 0
+        batches = iter(self.__iterate_minibatches(dataset, batchsize,
+                                                  augmentations, seed))
+        while True:
+            start_time = time.time()
+            batch = next(batches, None)
+            wait_time = time.time() - start_time
+            if batch is None:
+                break
             inputs, targets = batch
+            start_time = time.time()
             l, c, s, r, h = input_function(inputs, targets)
+            compute_time = time.time() - start_time
             total_loss += l
             total_correct += c
             total_selected += s
             total_relevant += r
             total_correct_relevant += h
             total_batches += 1
+            total_images += len(targets)
+            total_wait += wait_time
+            total_compute += compute_time
+            if callback:
+                callback(total_batches, wait_time, compute_time)
+        self.__timing = {'wait': total_wait,
+                         'compute': total_compute,
+                         'batches': total_batches,
+                         'images': total_images}
         avg_loss = total_loss / total_batches
         precision = total_correct_relevant / total_selected
         recall = total_correct_relevant / total_relevant
-        accuracy = total_correct / (batchsize * total_batches)
+        accuracy = total_correct / total_images
         return avg_loss, precision, recall, accuracy
 
-    def __iterate_minibatches(self, dataset, batchsize, shuffle=False):
-        """Split input data into batches and iterate over the minibatches."""
-        n = len(dataset[0])
-        assert len(dataset[1]) == n
-        batchsize = min(batchsize, n)
-        indices = numpy.arange(n)
-        numpy.random.shuffle(indices)
-        for start_idx in range(0, n - batchsize + 1, batchsize):
-            excerpt = indices[start_idx:start_idx + batchsize]
-            yield dataset[0][excerpt], dataset[1][excerpt]
+    def __iterate_minibatches(self, dataset, batchsize, augmentations=(),
+                              seed=None):
+        """Return an iterator over shuffled minibatches of the input data."""
+        return Prefetcher(dataset, batchsize, depth=self.prefetch,
+                          augmentations=augmentations, seed=seed)
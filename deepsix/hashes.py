@@ -0,0 +1,155 @@
+import os
+import hashlib
+import sqlite3
+import multiprocessing
+import numpy
+from PIL import Image
+from . import image_filenames_as_dict
+
+
+def difference_hash(img):
+    """Return the 64-bit difference hash (dHash) of a PIL.Image.
+
+    The image is reduced to a 9x8 greyscale thumbnail, and each bit records
+    whether a pixel is brighter than its left neighbour. Resized, recompressed
+    or slightly altered copies of an image mostly share the same hash. JPEG
+    files are decoded at a reduced scale to save time.
+
+    Return:
+        The hash as a signed 64-bit integer, so that sqlite can store it.
+    """
+    img.draft('L', (18, 16))
+    pixels = numpy.asarray(img.convert('L').resize((9, 8), Image.BILINEAR),
+                           dtype=numpy.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(numpy.packbits(bits).view('>i8')[0])
+
+
+def hash_file(path):
+    """Return the (path, size, mtime, sha1, dhash) row of an image file.
+
+    The dhash is None if the file cannot be read as an image.
+    """
+    stat = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha1.update(chunk)
+    try:
+        dhash = difference_hash(Image.open(path))
+    except (IOError, OSError, ValueError):
+        dhash = None
+    return path, stat.st_size, stat.st_mtime, sha1.hexdigest(), dhash
+
+
+class Hash_Index:
+    """A persistent index of the content hashes of image files.
+
+    Each file is a row (path, size, mtime, sha1, dhash) of a sqlite table,
+    indexed by both hashes: sha1 identifies exact copies, and the perceptual
+    dhash near-duplicates. A file is only hashed again if its size or
+    modification time has changed.
+
+    Attributes:
+        filename: The path of the sqlite database file.
+    """
+
+    def __init__(self, filename):
+        """Open the index in filename, creating it if necessary."""
+        self.filename = filename
+        self.__connection = sqlite3.connect(filename)
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, '
+            'dhash INTEGER)')
+        self.__connection.execute(
+            'CREATE INDEX IF NOT EXISTS hashes_sha1 ON hashes (sha1)')
+        self.__connection.execute(
+            'CREATE INDEX IF NOT EXISTS hashes_dhash ON hashes (dhash)')
+        self.__connection.commit()
+
+    def __len__(self):
+        """Return the number of files in the index."""
+        query = 'SELECT COUNT(*) FROM hashes'
+        return self.__connection.execute(query).fetchone()[0]
+
+    def rows(self):
+        """Return an iterator of (path, size, mtime, sha1, dhash) rows."""
+        return self.__connection.execute(
+            'SELECT path, size, mtime, sha1, dhash FROM hashes')
+
+    def update(self, paths, processes=1):
+        """Hash the files among paths that are new or changed.
+
+        Rows of indexed files that no longer exist are removed, so that a
+        deleted file is never taken for a copy of a new one.
+
+        Args:
+            paths: A list of image file paths.
+            processes: The number of worker processes hashing files.
+
+        Return:
+            The number of files hashed.
+        """
+        known = dict((row[0], row[1:3]) for row in self.rows())
+        missing = [path for path in known if not os.path.exists(path)]
+        for path in missing:
+            self.remove(path)
+        stale = []
+        for path in paths:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                stale.append(path)
+        if stale:
+            pool = multiprocessing.Pool(processes)
+            self.add(pool.imap_unordered(hash_file, stale, chunksize=64))
+            pool.close()
+            pool.join()
+        if stale or missing:
+            self.commit()
+        return len(stale)
+
+    def update_directories(self, directories, processes=1):
+        """Hash the new or changed images in directories, e.g. raw/."""
+        paths = []
+        for directory in directories:
+            if os.path.exists(directory):
+                paths.extend(image_filenames_as_dict(directory).values())
+        return self.update(paths, processes)
+
+    def add(self, rows):
+        """Insert or replace rows as returned by hash_file."""
+        self.__connection.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', rows)
+
+    def remove(self, path):
+        """Remove a file from the index."""
+        self.__connection.execute('DELETE FROM hashes WHERE path = ?',
+                                  (path,))
+
+    def find(self, sha1):
+        """Return the paths of the files with a given sha1."""
+        return [row[0] for row in self.__connection.execute(
+            'SELECT path FROM hashes WHERE sha1 = ?', (sha1,))]
+
+    def lookup(self, paths):
+        """Return the hashes of paths, which must be in the index.
+
+        Return:
+            A pair of a list of sha1 strings and a numpy int64 vector of
+            dhashes, with 0 for files that could not be read as images.
+        """
+        hashes = dict((row[0], row[3:]) for row in self.rows())
+        sha1 = [hashes[path][0] for path in paths]
+        dhash = numpy.array([hashes[path][1] or 0 for path in paths],
+                            dtype=numpy.int64)
+        return sha1, dhash
+
+    def commit(self):
+        """Write all changes to disk."""
+        self.__connection.commit()
+
+    def close(self):
+        """Commit all changes and close the database."""
+        self.__connection.commit()
+        self.__connection.close()
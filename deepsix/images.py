@@ -1,12 +1,90 @@
 import os
-import requests
-import shutil
-import json
-from PIL import Image
-import flickrapi
+import time
+import threading
+import random
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageDraw
 from . import image_filenames_as_dict
+from .store import Resource_Store
+from .hashes import Hash_Index, hash_file
 
-requests.packages.urllib3.disable_warnings()
+
+formats = {'BMP': '.bmp', 'JPEG': '.jpeg', 'PNG': '.png'}
+
+
+class Resize:
+    """A picklable alteration resizing a PIL.Image to a square.
+
+    Attributes:
+        size: The width and height of the resized image.
+        fast: Whether to decode JPEG files at a reduced scale and then
+            resample with a Lanczos filter, rather than decode them fully and
+            resample with the default filter.
+    """
+
+    def __init__(self, size, fast=False):
+        """Initialize the alteration with the target size."""
+        self.size = size
+        self.fast = fast
+
+    def __call__(self, img):
+        """Return img resized to self.size x self.size, in RGB mode.
+
+        Either way, images in other modes, e.g. greyscale or with a palette,
+        are converted to RGB before resampling, as Dataset would read them.
+        """
+        size = (self.size, self.size)
+        if not self.fast:
+            return img.convert('RGB').resize(size=size)
+        # a JPEG file not yet decoded is decoded at the smallest scale (1/2,
+        # 1/4, or 1/8) that is still at least self.size in each direction
+        img.draft('RGB', size)
+        return img.convert('RGB').resize(size=size, resample=Image.LANCZOS)
+
+
+def add_square(img):
+    """Return the input PIL.Image with a 16x16 white square drawn on it."""
+    img = img.convert('RGB')
+    draw = ImageDraw.Draw(img)
+    size = 16
+    x = random.randrange(img.size[0] - size)
+    y = random.randrange(img.size[1] - size)
+    square = [x, y, x + size, y + size]
+    draw.rectangle(square, fill=(255, 255, 255))
+    del draw
+    return img
+
+
+_version_task = {}
+
+
+def _init_version_worker(directory, alteration, update_raw, format,
+                         quality):
+    """Store the arguments shared by every make_version task in a worker."""
+    random.seed()  # forked workers would otherwise share a random state
+    _version_task['args'] = (directory, alteration, update_raw, format,
+                             quality)
+
+
+def _make_version(task):
+    """Make one version of the resource described by an (id, raw) pair.
+
+    Return:
+        The resource id, its raw path afterwards, and whether a new version
+        was created.
+    """
+    uid, raw = task
+    resource = Image_Manager.Image_Resource(id=uid, raw=raw)
+    try:
+        resource.make_version(*_version_task['args'])
+        return uid, resource.raw, True
+    except RuntimeWarning:
+        return uid, resource.raw, False
 
 
 class Image_Manager:
@@ -18,52 +96,60 @@ class Image_Manager:
     Attributes:
         directory: A directory path for images and related files.
         resources: A set of Image_Resource objects.
+        store: A Resource_Store recording each resource and whether it has
+            been downloaded.
     """
 
     def __init__(self, directory):
-        """Initialize image resources."""
+        """Initialize image resources from directory/resources.db.
+
+        If the database does not exist yet, it is created from the resources
+        listed in directory/resources.json and any images in directory/raw.
+        Resources marked as invalid or duplicate are not loaded.
+        """
         if not os.path.exists(directory):
             os.makedirs(directory)  # Ensure `directory` exists
         self.directory = directory
         self.resources = set()
-        # Load existing resources from JSON if possible
-        filename = os.path.join(directory, 'resources.json')
-        if os.path.exists(filename):
-            with open(filename) as f:
-                existing_resources = json.load(f)
-                for key, paths in existing_resources.items():
-                    url = paths[0]
-                    default_raw = os.path.join(directory, 'raw', key + '.jpeg')
-                    if os.path.exists(paths[1]):
-                        raw = paths[1]
-                    elif os.path.exists(default_raw):
-                        raw = default_raw
-                    else:
-                        raw = ''
-                    self.resources.add(self.Image_Resource(id=key,
-                                                           url=url,
-                                                           raw=raw))
-        # Add resources in directory/raw missing from the JSON for some reason
-        raw_dir = os.path.join(directory, 'raw')
-        if os.path.exists(raw_dir):
-            for uid, path in image_filenames_as_dict(raw_dir).items():
+        self.store = Resource_Store(os.path.join(directory, 'resources.db'))
+        if not len(self.store):
+            # Import existing resources from JSON if possible
+            filename = os.path.join(directory, 'resources.json')
+            if os.path.exists(filename):
+                self.store.import_json(filename, directory)
+            # Add resources in directory/raw missing from the JSON
+            raw_dir = os.path.join(directory, 'raw')
+            if os.path.exists(raw_dir):
+                self.store.add(
+                    self.Image_Resource(id=uid, url='', raw=path)
+                    for uid, path in image_filenames_as_dict(raw_dir).items())
+            self.store.commit()
+        for uid, url, raw, status in self.store.rows():
+            if status not in ('invalid', 'duplicate'):
                 self.resources.add(self.Image_Resource(id=uid,
-                                                       url='',
-                                                       raw=path))
+                                                       url=url,
+                                                       raw=raw))
 
     def __str__(self):
         """Return a string representation of the image resource set."""
         return '\n'.join(str(s) for s in self.resources)
 
-    def save(self):
-        """Save image resources to a JSON file."""
-        filename = os.path.join(self.directory, 'resources.json')
-        with open(filename, 'w') as f:
-            json.dump(
-                {r.id: [r.url, r.raw] for r in self.resources},
-                f,
-                indent=2,
-                sort_keys=True)
+    def save(self, export_json=True):
+        """Save image resources to directory/resources.db.
+
+        Downloads and new versions are recorded in the database as they
+        happen; this adds any resources not yet in it and commits.
+
+        Args:
+            export_json: Whether to also export the resources to
+                directory/resources.json, as earlier versions saved them,
+                for tools that read that file.
+        """
+        self.store.add(self.resources)
+        self.store.commit()
+        if export_json:
+            self.store.export_json(os.path.join(self.directory,
+                                                'resources.json'))
 
     def find_resources(self, **kwargs):
         """Return an iterator of Image_Resources from a source."""
@@ -74,57 +160,282 @@ class Image_Manager:
         i = 0
         for r in self.find_resources(**kwargs):
             self.resources.add(r)
+            self.store.add([r])
             i += 1
             if i >= maximum:
                 break
 
-    def download_all(self):
-        """Download all image resources to self.directory/raw."""
+    def discover(self, queries, maximum, workers=4):
+        """Yield new Image_Resources from concurrent find_resources queries.
+
+        Each query runs on its own thread, at most workers at a time, and
+        resources are yielded as soon as any query finds them. Resources are
+        deduplicated by id on the fly, and those already downloaded or marked
+        invalid or duplicate in self.store are skipped. Each yielded resource
+        is added to self.resources and self.store.
+
+        Args:
+            queries: A list of dictionaries of keyword arguments for
+                find_resources, e.g. [{'tags': 'cat'}, {'tags': 'dog'}].
+            maximum: The maximum number of resources collected from each
+                query, as for add_resources.
+            workers: The number of queries running at once.
+        """
+        found = queue.Queue()
+        limit = threading.Semaphore(workers)
+        stop = threading.Event()
+
+        def search(query):
+            with limit:
+                try:
+                    i = 0
+                    for r in self.find_resources(**query):
+                        if i >= maximum or stop.is_set():
+                            break
+                        found.put(r)
+                        i += 1
+                    print('Found {} images for {}.'.format(i, query))
+                except Exception as e:
+                    print('Searching for {} failed: {}'.format(query, e))
+                finally:
+                    found.put(None)
+
+        seen = set(row[0] for row in self.store.rows()
+                   if row[3] != 'pending')
+        for query in queries:
+            thread = threading.Thread(target=search, args=(query,))
+            thread.daemon = True
+            thread.start()
+        remaining = len(queries)
+        try:
+            while remaining:
+                r = found.get()
+                if r is None:
+                    remaining -= 1
+                elif r.id not in seen:
+                    seen.add(r.id)
+                    if r not in self.resources:
+                        self.resources.add(r)
+                        self.store.add([r])
+                    yield r
+        finally:
+            stop.set()
+
+    def download_all(self, **kwargs):
+        """Download all pending image resources to self.directory/raw.
+
+        Only resources marked as pending in self.store are downloaded.
+
+        Args:
+            **kwargs: Passed to self.download.
+        """
+        self.store.add(self.resources)
+        todo = set(row[0] for row in self.store.rows('pending'))
+        todo = [r for r in self.resources if r.id in todo]
+        self.download(todo, len(todo), **kwargs)
+
+    def discover_and_download(self, queries, maximum, discovery_workers=4,
+                              **kwargs):
+        """Download resources while they are still being discovered.
+
+        Args:
+            queries: A list of dictionaries of keyword arguments for
+                find_resources.
+            maximum: The maximum number of resources collected from each
+                query.
+            discovery_workers: The number of queries running at once.
+            **kwargs: Passed to self.download.
+        """
+        self.download(self.discover(queries, maximum, discovery_workers),
+                      **kwargs)
+
+    def download(self, resources, n=None, workers=1, rate_limit=None,
+                 retries=3, backoff=1., checkpoint=100, timeout=30,
+                 deduplicate=False):
+        """Download image resources to self.directory/raw as they arrive.
+
+        The outcome of each download is recorded in self.store. Downloads run
+        on a pool of worker threads sharing one pooled requests.Session, so
+        connections to each host are reused. A failed connection is retried
+        with exponential backoff; a resource that still fails is left pending
+        for a later run instead of aborting.
+
+        Args:
+            resources: An iterable of Image_Resources, which may still be
+                producing resources while the first ones download.
+            n: The number of resources, if known, for progress messages.
+            workers: The number of concurrent download threads.
+            rate_limit: The maximum number of requests per second sent to any
+                one host, or None for no limit.
+            retries: The number of times to retry a failed connection.
+            backoff: The delay in seconds before the first retry, doubled for
+                each subsequent retry.
+            checkpoint: Commit self.store after this many completed
+                downloads, or None to commit only at the end.
+            timeout: Seconds to wait for the server before retrying.
+            deduplicate: If true, each new image is hashed, and deleted and
+                marked as duplicate if an identical file is already in raw/,
+                as recorded in the Hash_Index directory/hashes.db.
+        """
+        from .web import pooled_session, transient_errors
         subdirectory_path = os.path.join(self.directory, 'raw')
         if not os.path.exists(subdirectory_path):
             os.makedirs(subdirectory_path)
-        i, n = 1, len(self.resources)
+        session = pooled_session(workers, rate_limit)
+        hashes = None
+        if deduplicate:
+            hashes = Hash_Index(os.path.join(self.directory, 'hashes.db'))
+            hashes.update_directories([subdirectory_path])
+
+        def fetch(r):
+            for attempt in range(retries + 1):
+                try:
+                    r.download(subdirectory_path, session, timeout)
+                    if deduplicate:
+                        return 'new', hash_file(r.raw)
+                    return 'new', None
+                except RuntimeWarning:
+                    return 'old', None
+                except ValueError:
+                    return 'invalid', None
+                except transient_errors:
+                    if attempt < retries:
+                        time.sleep(backoff * 2 ** attempt)
+            return 'failed', None
+
+        i, n = 1, '?' if n is None else n
         invalid = set()
-        for r in self.resources:
-            try:
-                r.download(subdirectory_path)
-                print('{}/{}: New file {} successfully downloaded.'
-                      ''.format(i, n, r.id))
-            except RuntimeWarning:
-                print('{}/{}: Old file {} already exists.'
-                      ''.format(i, n, r.id))
-            except ValueError:
-                print('{}/{}: Downloading {} received an invalid response.'
-                      ''.format(i, n, r.url))
-                invalid.add(r)
-            except requests.exceptions.ConnectionError:
-                print('{}/{}: Downloading {} timed out.')
-                break
-            i += 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            resources = iter(resources)
+            while True:
+                # keep a bounded number of downloads in flight
+                for r in resources:
+                    pending[pool.submit(fetch, r)] = r
+                    if len(pending) >= 4 * workers:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    r = pending.pop(future)
+                    status, row = future.result()
+                    if row and [path for path in hashes.find(row[3])
+                                if path != r.raw]:
+                        os.remove(r.raw)
+                        r.raw = ''
+                        status = 'duplicate'
+                    elif row:
+                        hashes.add([row])
+                    if status == 'new':
+                        print('{}/{}: New file {} successfully downloaded.'
+                              ''.format(i, n, r.id))
+                        self.store.update(r, 'ok')
+                    elif status == 'old':
+                        print('{}/{}: Old file {} already exists.'
+                              ''.format(i, n, r.id))
+                        self.store.update(r, 'ok')
+                    elif status == 'invalid':
+                        print('{}/{}: Downloading {} received an invalid '
+                              'response.'.format(i, n, r.url))
+                        self.store.update(r, 'invalid')
+                        invalid.add(r)
+                    elif status == 'duplicate':
+                        print('{}/{}: Downloaded {} is a duplicate.'
+                              ''.format(i, n, r.id))
+                        self.store.update(r, 'duplicate')
+                        invalid.add(r)
+                    else:
+                        print('{}/{}: Downloading {} failed after {} retries.'
+                              ''.format(i, n, r.url, retries))
+                    if checkpoint and i % checkpoint == 0:
+                        self.store.commit()
+                        if deduplicate:
+                            hashes.commit()
+                    i += 1
+        session.close()
+        self.store.commit()
+        if deduplicate:
+            hashes.close()
         self.resources.difference_update(invalid)
 
-    def make_versions(self, version_key, alteration, update_raw=False):
-        """Create a new, altered version of each image resource."""
+    def make_versions(self, version_key, alteration, update_raw=False,
+                      processes=1, format='BMP', quality=None):
+        """Create a new, altered version of each image resource.
+
+        Args:
+            version_key: The name of the subdirectory to save versions in.
+            alteration: A function returning a PIL.Image from input img. It
+                must be picklable (e.g. a module-level function or an
+                instance of a module-level class) when processes > 1.
+            update_raw: If true, each new version will be considered the new
+                raw image of its resource.
+            processes: The number of worker processes to spread the work
+                across.
+            format: The file format of the versions: 'BMP', 'JPEG', or
+                'PNG'.
+            quality: The JPEG quality of the versions, or None for the PIL
+                default.
+        """
+        if format not in formats:
+            raise ValueError('Unsupported format {}.'.format(format))
         subdirectory_path = os.path.join(self.directory, version_key)
         if not os.path.exists(subdirectory_path):
             os.makedirs(subdirectory_path)
-        i, n = 1, len(self.resources)
-        for r in self.resources:
-            try:
-                r.make_version(subdirectory_path, alteration, update_raw)
-                print('{}/{}: New version {} successfully created.'
-                      ''.format(i, n, r.id))
-            except RuntimeWarning:
-                print('{}/{}: Old file {} already exists.'
-                      ''.format(i, n, r.id))
-            i += 1
-
-    def resize_raws(self, size):
-        """Resize each image resource and treat the updated image as raw."""
+        resources = {r.id: r for r in self.resources}
+        # resources that were never downloaded have nothing to alter
+        tasks = [(r.id, r.raw) for r in self.resources if r.raw]
+        if processes > 1:
+            pool = multiprocessing.Pool(
+                processes,
+                initializer=_init_version_worker,
+                initargs=(subdirectory_path, alteration, update_raw, format,
+                          quality))
+            results = pool.imap(_make_version, tasks, chunksize=16)
+        else:
+            pool = None
+            _init_version_worker(subdirectory_path, alteration, update_raw,
+                                 format, quality)
+            results = map(_make_version, tasks)
+        i, n = 1, len(tasks)
+        try:
+            for uid, raw, created in results:
+                if created:
+                    print('{}/{}: New version {} successfully created.'
+                          ''.format(i, n, uid))
+                else:
+                    print('{}/{}: Old file {} already exists.'
+                          ''.format(i, n, uid))
+                resources[uid].raw = raw
+                if update_raw:
+                    self.store.update(resources[uid])
+                i += 1
+        finally:
+            # stops the workers even if an alteration failed
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.store.commit()
+
+    def resize_raws(self, size, processes=1, fast=False, format='BMP',
+                    quality=None):
+        """Resize each image resource and treat the updated image as raw.
+
+        Args:
+            size: The width and height of the resized images.
+            processes: The number of worker processes.
+            fast: Whether to decode JPEG files at a reduced scale before
+                resampling, as described for Resize.
+            format, quality: The file format and JPEG quality of the resized
+                images, as for make_versions.
+        """
         self.make_versions(
             version_key=str(size),
-            alteration=lambda img: img.resize(size=(size, size)),
-            update_raw=True)
+            alteration=Resize(size, fast),
+            update_raw=True,
+            processes=processes,
+            format=format,
+            quality=quality)
 
     class Image_Resource:
         """The URL and local path to a raw image resource.
@@ -157,8 +468,16 @@ class Image_Manager:
             """Return whether two image resources have different ids."""
             return self.id != other.id
 
-        def download(self, directory):
-            """Download a raw version of the image to a directory."""
+        def download(self, directory, session=None, timeout=None):
+            """Download a raw version of the image to a directory.
+
+            Args:
+                directory: The directory path to save the image in.
+                session: A requests.Session to send the request with, or
+                    None for a one-off connection.
+                timeout: Seconds to wait for the server, or None to wait
+                    indefinitely.
+            """
             filename = '{}/{}.jpeg'.format(directory, self.id)
             if self.raw and self.raw == filename:
                 raise RuntimeWarning('Already downloaded.')
@@ -168,17 +487,60 @@ class Image_Manager:
                     raise RuntimeWarning('A file already exists here.')
                 else:
                     self.raw = ''
-                    r = requests.get(self.url, stream=True)
-                    if all([r.status_code == 200,
-                            r.headers['Content-Type'] == 'image/jpeg']):
-                        with open(filename, "wb") as out_file:
-                            r.raw.decode_content = True
-                            shutil.copyfileobj(r.raw, out_file)
+                    if session is None:
+                        import requests as session
+                    r = session.get(self.url, stream=True, timeout=timeout)
+                    try:
+                        if r.status_code >= 500:
+                            r.raise_for_status()  # worth retrying
+                        content_type = r.headers.get('Content-Type')
+                        if all([r.status_code == 200,
+                                content_type == 'image/jpeg']):
+                            # write to a temporary file so that an interrupted
+                            # download never looks like a finished one
+                            partial = filename + '.part'
+                            try:
+                                with open(partial, 'wb') as out_file:
+                                    for chunk in r.iter_content(65536):
+                                        out_file.write(chunk)
+                                os.rename(partial, filename)
+                            finally:
+                                if os.path.exists(partial):
+                                    os.remove(partial)
                             self.raw = filename
-                    else:
-                        raise ValueError('Invalid response.')
+                        else:
+                            raise ValueError('Invalid response.')
+                    finally:
+                        r.close()
+
+        def fetch(self, session=None, timeout=None):
+            """Download the image into memory, without saving it.
 
-        def make_version(self, directory, alteration, update_raw=False):
+            Args:
+                session: A requests.Session to send the request with, or
+                    None for a one-off connection.
+                timeout: Seconds to wait for the server, or None to wait
+                    indefinitely.
+
+            Return:
+                The content of the image file as bytes.
+            """
+            if session is None:
+                import requests as session
+            r = session.get(self.url, timeout=timeout)
+            try:
+                if r.status_code >= 500:
+                    r.raise_for_status()  # worth retrying
+                content_type = r.headers.get('Content-Type')
+                if not all([r.status_code == 200,
+                            content_type == 'image/jpeg']):
+                    raise ValueError('Invalid response.')
+                return r.content
+            finally:
+                r.close()
+
+        def make_version(self, directory, alteration, update_raw=False,
+                         format='BMP', quality=None):
             """Alter the image and save a version in a directory.
 
             Args:
@@ -186,14 +548,23 @@ class Image_Manager:
                 alteration: A function returning a PIL.Image from input img.
                 update_raw: If true, the new image will be considered the new
                     raw image.
+                format: The file format of the version: 'BMP', 'JPEG', or
+                    'PNG'.
+                quality: The JPEG quality of the version, or None for the
+                    PIL default.
             """
-            filename = '{}/{}.bmp'.format(directory, self.id)
+            filename = '{}/{}{}'.format(directory, self.id, formats[format])
             if os.path.exists(filename):
                 raise RuntimeWarning('A version is already here.')
             else:
                 img = Image.open(self.raw)
                 img = alteration(img)
-                img.save(filename, 'BMP')
+                options = {}
+                if format == 'JPEG':
+                    img = img.convert('RGB')
+                    if quality:
+                        options['quality'] = quality
+                img.save(filename, format, **options)
             if update_raw:
                 self.raw = filename
 
@@ -206,17 +577,31 @@ class Flickr_Manager(Image_Manager):
         resources: A dictionary of Flickr_Resource objects organized by id.
     """
 
-    def __init__(self, api_key, directory):
-        """Load a Flickr API key file and initialize image resources."""
+    def __init__(self, api_key, directory, api=None):
+        """Load a Flickr API key file and initialize image resources.
+
+        Args:
+            api_key: The path of a file containing a Flickr API key and
+                secret on two lines.
+            directory: A directory path for images and related files.
+            api: A function taking the key and secret and returning a Flickr
+                API session, or a stand-in with the same walk() method. By
+                default, flickrapi.FlickrAPI, imported when first needed.
+        """
         Image_Manager.__init__(self, directory)
         with open(api_key) as k:
             api_keys = k.readlines()
             self.__api_key = api_keys[0].rstrip()
             self.__api_secret = api_keys[1].rstrip()
+        self.__api = api
 
     def find_resources(self, tags):
         """Return an iterator of Flickr_Resources from the Flickr API."""
-        session = flickrapi.FlickrAPI(self.__api_key, self.__api_secret)
+        api = self.__api
+        if api is None:
+            import flickrapi
+            api = flickrapi.FlickrAPI
+        session = api(self.__api_key, self.__api_secret)
         for photo in session.walk(tag_mode='all', tags=tags, per_page=500):
             yield self.Flickr_Resource(id=photo.get('id'),
                                        farm=photo.get('farm'),
@@ -0,0 +1,289 @@
+import csv
+import json
+import numpy
+from numpy.lib.stride_tricks import as_strided
+from . import image_filenames_as_dict
+from .batches import Image_Stream
+
+
+def linear(x):
+    """Return x unchanged."""
+    return x
+
+
+def rectify(x):
+    """Return max(x, 0) elementwise."""
+    return numpy.maximum(x, 0)
+
+
+def leaky_rectify(x, leakiness=0.01):
+    """Return x where positive and leakiness * x elsewhere."""
+    return numpy.maximum(x, leakiness * x)
+
+
+def sigmoid(x):
+    """Return the logistic function of x elementwise."""
+    return 1 / (1 + numpy.exp(-x))
+
+
+def softmax(x):
+    """Return the softmax of each row of x."""
+    x = numpy.exp(x - x.max(axis=1, keepdims=True))
+    return x / x.sum(axis=1, keepdims=True)
+
+
+nonlinearities = {'linear': linear, 'rectify': rectify,
+                  'leaky_rectify': leaky_rectify, 'sigmoid': sigmoid,
+                  'softmax': softmax, 'tanh': numpy.tanh}
+
+
+def conv2d(inputs, W, b):
+    """Return the valid convolution of a batch with a bank of filters.
+
+    As in Lasagne's Conv2DLayer, the filters are flipped (a true
+    convolution) and the output is smaller than the input by the filter size
+    less one. The sliding windows of the input are viewed without copying
+    with as_strided, and multiplied with the filters as one matrix product.
+
+    Args:
+        inputs: An array of shape (n, channels, rows, columns).
+        W: The filters, of shape (filters, channels, height, width).
+        b: The biases, of shape (filters,).
+    """
+    n, channels, rows, columns = inputs.shape
+    filters, _, height, width = W.shape
+    inputs = numpy.ascontiguousarray(inputs)
+    s = inputs.strides
+    windows = as_strided(
+        inputs,
+        shape=(n, channels, rows - height + 1, columns - width + 1, height,
+               width),
+        strides=(s[0], s[1], s[2], s[3], s[2], s[3]))
+    output = numpy.tensordot(windows, W[:, :, ::-1, ::-1],
+                             axes=([1, 4, 5], [1, 2, 3]))
+    output += b
+    return output.transpose(0, 3, 1, 2)
+
+
+def max_pool(inputs, pool_size):
+    """Return the maximum of each non-overlapping pool of a batch.
+
+    As in Lasagne's MaxPool2DLayer with ignore_border=True, rows and columns
+    that do not fill a whole pool are dropped.
+    """
+    n, channels, rows, columns = inputs.shape
+    height, width = pool_size
+    rows, columns = rows // height, columns // width
+    inputs = inputs[:, :, :rows * height, :columns * width]
+    return inputs.reshape(n, channels, rows, height, columns, width).max(
+        axis=(3, 5))
+
+
+def dense(inputs, W, b):
+    """Return the affine map of a batch, flattening each input."""
+    return inputs.reshape(len(inputs), -1).dot(W) + b
+
+
+def describe(network):
+    """Return a JSON-serializable description of a Lasagne network.
+
+    Only the layers supported by Inference_Network are accepted: an input
+    layer, Conv2DLayer with no padding and unit stride, MaxPool2DLayer with
+    non-overlapping pools, DenseLayer, and DropoutLayer.
+    Attributes that older versions of Lasagne lack take their default
+    values, so that any unsupported network raises ValueError.
+
+    Raise:
+        ValueError: If the network has any other layer.
+    """
+    import lasagne
+    from lasagne import layers as L
+    description = []
+
+    def name_of(nonlinearity):
+        if isinstance(nonlinearity, lasagne.nonlinearities.LeakyRectify):
+            return {'nonlinearity': 'leaky_rectify',
+                    'leakiness': nonlinearity.leakiness}
+        name = getattr(nonlinearity, '__name__', None)
+        if name == 'identity':
+            name = 'linear'
+        if name not in nonlinearities:
+            raise ValueError('Unsupported nonlinearity {}.'.format(
+                nonlinearity))
+        return {'nonlinearity': name}
+
+    for layer in L.get_all_layers(network):
+        if isinstance(layer, L.InputLayer):
+            item = {'type': 'Input', 'shape': list(layer.shape[1:])}
+        elif (isinstance(layer, L.Conv2DLayer) and
+              tuple(getattr(layer, 'stride', (1, 1))) == (1, 1) and
+              tuple(getattr(layer, 'pad', (0, 0))) == (0, 0) and
+              getattr(layer, 'flip_filters', True) and
+              not getattr(layer, 'untie_biases', False) and
+              layer.b is not None):
+            item = {'type': 'Conv2D', 'num_filters': layer.num_filters,
+                    'filter_size': list(layer.filter_size)}
+            item.update(name_of(layer.nonlinearity))
+        elif (isinstance(layer, L.MaxPool2DLayer) and
+              tuple(getattr(layer, 'stride', None) or layer.pool_size) ==
+              tuple(layer.pool_size) and
+              tuple(getattr(layer, 'pad', (0, 0))) == (0, 0) and
+              getattr(layer, 'ignore_border', False)):
+            item = {'type': 'MaxPool2D', 'pool_size': list(layer.pool_size)}
+        elif (isinstance(layer, L.DenseLayer) and
+              getattr(layer, 'b', None) is not None):
+            item = {'type': 'Dense', 'num_units': layer.num_units}
+            item.update(name_of(layer.nonlinearity))
+        elif isinstance(layer, L.DropoutLayer):
+            item = {'type': 'Dropout'}
+        else:
+            raise ValueError('Unsupported layer {}.'.format(layer))
+        description.append(item)
+    return description
+
+
+class Inference_Network:
+    """A trained network evaluated with NumPy alone, without Theano.
+
+    The network is given by a description of its layers, as returned by
+    describe() and saved by Experiment.save() in network.json, and its
+    parameters are read from learned_parameters.npy. Dropout is the identity,
+    so the output matches the deterministic predictions of Experiment.
+
+    Attributes:
+        layers: A list of dictionaries describing each layer in order.
+        parameters: A list of the weight and bias arrays of the Conv2D and
+            Dense layers, in the order of lasagne.layers.get_all_params.
+    """
+
+    def __init__(self, layers, parameters=None):
+        """Initialize the network from a description and parameters."""
+        self.layers = layers
+        self.parameters = parameters or []
+
+    @classmethod
+    def load(cls, description, parameters):
+        """Load a network from a network.json and learned_parameters.npy."""
+        with open(description) as f:
+            network = cls(json.load(f))
+        network.load_parameters(parameters)
+        return network
+
+    @property
+    def input_shape(self):
+        """The shape (3, width, height) of each input image."""
+        return tuple(self.layers[0]['shape'])
+
+    @property
+    def n_classes(self):
+        """The number of outputs of the last Dense layer."""
+        return [x for x in self.layers if x['type'] == 'Dense'][-1][
+            'num_units']
+
+    def load_parameters(self, filename):
+        """Load learned parameters saved by Experiment.save()."""
+        parameters = numpy.load(filename, allow_pickle=True)
+        self.parameters = [numpy.asarray(x, dtype=numpy.float32)
+                           for x in parameters]
+
+    def predict(self, inputs, chunk=64):
+        """Return the output of the network for a batch of images.
+
+        Args:
+            inputs: A float32 array of shape (n, 3, width, height) with
+                values in [0,1].
+            chunk: The number of images passed through the network at once,
+                which bounds the size of the intermediate arrays.
+        """
+        outputs = [self.__forward(inputs[start:start + chunk])
+                   for start in range(0, len(inputs), chunk)]
+        if not outputs:
+            return numpy.empty((0, self.n_classes), dtype=numpy.float32)
+        return numpy.concatenate(outputs).astype(numpy.float32)
+
+    def predict_directories(self, directories, filename, batchsize=1000,
+                            processes=1):
+        """Write predicted class probabilities, as for Experiment.predict.
+
+        Return:
+            The number of images scored.
+        """
+        return predict_images(self.predict, self.input_shape, self.n_classes,
+                              directories, filename, batchsize, processes)
+
+    def __forward(self, x):
+        """Pass one chunk of images through the layers."""
+        parameters = iter(self.parameters)
+        for layer in self.layers:
+            if layer['type'] == 'Conv2D':
+                x = conv2d(x, next(parameters), next(parameters))
+            elif layer['type'] == 'Dense':
+                x = dense(x, next(parameters), next(parameters))
+            elif layer['type'] == 'MaxPool2D':
+                x = max_pool(x, layer['pool_size'])
+            if 'nonlinearity' in layer:
+                nonlinearity = nonlinearities[layer['nonlinearity']]
+                if 'leakiness' in layer:
+                    x = nonlinearity(x, layer['leakiness'])
+                else:
+                    x = nonlinearity(x)
+        return x
+
+
+def predict_images(predict, shape, n_classes, directories, filename,
+                   batchsize=1000, processes=1):
+    """Write the predicted class probabilities of images in directories.
+
+    Images are decoded on worker processes while the network scores the
+    previous batch, and results are written as each batch completes, so
+    memory use does not depend on the number of images.
+
+    Args:
+        predict: A function returning the class probabilities of a float32
+            batch of images.
+        shape: The shape (3, width, height) of each input image.
+        n_classes: The number of classes.
+        directories: A list of directory paths containing images.
+        filename: The output path. A .npy file receives a float32 array
+            with one row of probabilities per image (NaN for images that
+            could not be scored), and a file ending in _ids.txt next to it
+            the image ids in the same order. Any other file is written as
+            CSV with an id column followed by one column for each class.
+        batchsize: The number of images scored at once.
+        processes: The number of worker processes decoding images.
+
+    Return:
+        The number of images scored.
+    """
+    images = []
+    for directory in directories:
+        images.extend(sorted(image_filenames_as_dict(directory).items()))
+    stream = Image_Stream([path for _, path in images], batchsize,
+                          shape=shape, processes=processes)
+    if filename.endswith('.npy'):
+        with open(filename[:-len('.npy')] + '_ids.txt', 'w') as f:
+            f.writelines(uid + '\n' for uid, _ in images)
+        output = numpy.lib.format.open_memmap(
+            filename, mode='w+', dtype=numpy.float32,
+            shape=(len(images), n_classes))
+        output[:] = numpy.nan
+    else:
+        csvfile = open(filename, 'w')
+        output = csv.writer(csvfile)
+        output.writerow(['id'] + ['P{}'.format(i)
+                                  for i in range(n_classes)])
+    scored = 0
+    for indices, inputs in stream:
+        probabilities = predict(inputs)
+        if filename.endswith('.npy'):
+            output[indices] = probabilities
+        else:
+            output.writerows([images[i][0]] + list(p)
+                             for i, p in zip(indices, probabilities))
+        scored += len(indices)
+        print('Scored {}/{} images'.format(scored, len(images)))
+    if filename.endswith('.npy'):
+        output.flush()
+    else:
+        csvfile.close()
+    return scored
@@ -0,0 +1,257 @@
+import io
+import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+from .images import Resize, formats
+from .web import pooled_session, transient_errors
+from .data import image_array
+
+
+def _fetch(r, session, retries, backoff, timeout):
+    """Return the status and content of an image resource.
+
+    A resource with a raw file on disk is read from it instead of being
+    downloaded again. A failed connection is retried with exponential
+    backoff, as in Image_Manager.download.
+
+    Return:
+        A pair of a status, 'old', 'new', 'invalid', or 'failed', and the
+        content of the image file as bytes, or None.
+    """
+    if r.raw and os.path.exists(r.raw):
+        with open(r.raw, 'rb') as f:
+            return 'old', f.read()
+    for attempt in range(retries + 1):
+        try:
+            return 'new', r.fetch(session, timeout)
+        except ValueError:
+            return 'invalid', None
+        except transient_errors:
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+    return 'failed', None
+
+
+class Ingest_Pipeline:
+    """A streaming pipeline from image resources to a Shard_Store.
+
+    Each image goes through download, resize, an optional alteration, and
+    conversion to an array in memory, and is written straight to the shards
+    of the store, instead of being written to raw/, the resized directory,
+    and each version directory in turn and read back by Dataset. Images are
+    downloaded on one pool of threads and processed on another, and the
+    calling thread writes them out as they complete. The number of images in
+    flight is bounded, so memory use does not depend on the number of
+    images, and a slow stage holds back the ones before it.
+
+    As in Shard_Store.append, each image appears in the store once, as one
+    of its versions chosen uniformly at random: the resized image itself,
+    labelled by the source directory/<size>, or one of the alterations,
+    labelled by directory/<version_key>. The manifest records the path the
+    chosen version would have under the usual pipeline, so a store built
+    by ingesting and one built from version directories agree.
+
+    Resources are only skipped by id. Unlike download and Dataset with
+    deduplicate, ingesting does not look for images with identical or
+    near-identical content.
+
+    Attributes:
+        manager: The Image_Manager whose resources are ingested. The outcome
+            of each download is recorded in its store.
+        store: The Shard_Store the images are written to.
+        size: The width and height of the resized images.
+        versions: A list of (version_key, alteration) pairs, e.g.
+            [('square', add_square)].
+        keep: Whether to also save the raw image, the resized image, and the
+            chosen version to their usual files, for audit. Resources whose
+            raw image is not kept are marked as ingested in manager.store.
+    """
+
+    def __init__(self, manager, store, size=64, versions=(), keep=False,
+                 fast=False, format='BMP', quality=None):
+        """Initialize the pipeline.
+
+        Args:
+            manager: An Image_Manager.
+            store: A Shard_Store.
+            size: The width and height of the resized images.
+            versions: A list of (version_key, alteration) pairs.
+            keep: Whether to save the intermediate images to files.
+            fast: Whether to decode JPEG files at a reduced scale, as for
+                Resize.
+            format, quality: The file format and JPEG quality of the kept
+                resized images and versions, as for make_versions.
+        """
+        if format not in formats:
+            raise ValueError('Unsupported format {}.'.format(format))
+        self.manager = manager
+        self.store = store
+        self.size = size
+        self.versions = list(versions)
+        self.keep = keep
+        self.__resize = Resize(size, fast)
+        self.__format = format
+        self.__quality = quality
+
+    def sources(self):
+        """Return the source directory path of each possible version."""
+        keys = [str(self.size)] + [key for key, _ in self.versions]
+        return [os.path.join(self.manager.directory, key) for key in keys]
+
+    def run(self, resources=None, workers=8, threads=4, rate_limit=None,
+            retries=3, backoff=1., timeout=30, queue_size=64,
+            checkpoint=100):
+        """Ingest image resources into the store.
+
+        Args:
+            resources: An iterable of Image_Resources, which may still be
+                producing resources while the first ones are ingested, as
+                returned by Image_Manager.discover. By default, all the
+                resources of the manager. Resources with an id already in
+                the store are skipped.
+            workers: The number of concurrent download threads.
+            threads: The number of threads decoding and resizing images.
+                PIL releases the interpreter lock while decoding and
+                resampling, so these run in parallel.
+            rate_limit: The maximum number of requests per second sent to
+                any one host, or None for no limit.
+            retries, backoff, timeout: As for Image_Manager.download.
+            queue_size: The maximum number of images downloading or waiting
+                to be processed at once.
+            checkpoint: Commit manager.store after this many images, or None
+                to commit only at the end. A resource is only marked as
+                ok or ingested once the manifest row of its image is saved,
+                so an interrupted run leaves the rest pending.
+
+        Return:
+            The number of images added to the store.
+        """
+        if resources is None:
+            resources = list(self.manager.resources)
+        known = set(os.path.splitext(os.path.basename(row[5]))[0]
+                    for row in self.store.manifest)
+        resources = (r for r in resources if r.id not in known)
+        if self.keep:
+            for directory in ([os.path.join(self.manager.directory, 'raw')] +
+                              self.sources()):
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+        session = pooled_session(workers, rate_limit)
+        unsaved = {}
+
+        def record(rows):
+            for row in rows:
+                r = unsaved.pop(row[5])
+                self.manager.store.update(r, 'ok' if r.raw else 'ingested')
+            self.manager.store.commit()
+
+        added = self.store.extend(self.__stream(
+            resources, unsaved, session, workers, threads, retries, backoff,
+            timeout, queue_size, checkpoint), record)
+        session.close()
+        self.manager.store.commit()
+        return added
+
+    def __process(self, r, status, content):
+        """Resize and alter one downloaded image, and convert it to an array.
+
+        An image that cannot be decoded, resized, or altered, e.g. one too
+        small for a square, marks its resource as invalid.
+
+        Return:
+            A tuple of the status of the resource, and the array, source
+            path, and manifest path of the chosen version, or None for each
+            if the resource has no image.
+        """
+        if content is None:
+            return status, None, None, None
+        sources = self.sources()
+        chosen = random.randrange(len(sources))
+        uid = r.id + formats[self.__format]
+        try:
+            resized = img = self.__resize(Image.open(io.BytesIO(content)))
+            if chosen:
+                # an alteration may draw on its input, and the resized
+                # image may still be saved as it was
+                img = self.versions[chosen - 1][1](
+                    resized.copy() if self.keep else resized)
+            array = image_array(img)
+        except (IOError, OSError, ValueError):
+            return 'invalid', None, None, None
+        if self.keep:
+            if status == 'new':
+                r.raw = os.path.join(self.manager.directory, 'raw',
+                                     r.id + '.jpeg')
+                with open(r.raw, 'wb') as f:
+                    f.write(content)
+            self.__save(resized, os.path.join(sources[0], uid))
+            if chosen:
+                self.__save(img, os.path.join(sources[chosen], uid))
+        return (status, array, sources[chosen],
+                os.path.join(sources[chosen], uid))
+
+    def __save(self, img, filename):
+        """Save an image in the output format, as in make_version."""
+        options = {}
+        if self.__format == 'JPEG':
+            img = img.convert('RGB')
+            if self.__quality:
+                options['quality'] = self.__quality
+        img.save(filename, self.__format, **options)
+
+    def __stream(self, resources, unsaved, session, workers, threads,
+                 retries, backoff, timeout, queue_size, checkpoint):
+        """Yield (image, source, path) triples as images are processed.
+
+        Resources are drawn, and recorded in manager.store, on the calling
+        thread, since a sqlite connection cannot be shared between threads
+        and resources may come from a generator reading one. The resource of
+        each yielded image is left in unsaved, by manifest path, until its
+        manifest row is saved.
+        """
+        i = 1
+        downloads = ThreadPoolExecutor(max_workers=workers)
+        images = ThreadPoolExecutor(max_workers=threads)
+        pending = {}
+        resources = iter(resources)
+        try:
+            while True:
+                # keep a bounded number of images in flight
+                if len(pending) < queue_size:
+                    for r in resources:
+                        future = downloads.submit(_fetch, r, session, retries,
+                                                  backoff, timeout)
+                        pending[future] = r, 'download'
+                        if len(pending) >= queue_size:
+                            break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    r, stage = pending.pop(future)
+                    if stage == 'download':
+                        future = images.submit(self.__process, r,
+                                               *future.result())
+                        pending[future] = r, 'process'
+                        continue
+                    status, image, source, path = future.result()
+                    if image is not None:
+                        print('{}: Ingested {} as {}.'.format(i, r.id, path))
+                        unsaved[path] = r
+                        yield image, source, path
+                    elif status == 'invalid':
+                        print('{}: Downloading {} received an invalid '
+                              'response.'.format(i, r.url))
+                        self.manager.store.update(r, 'invalid')
+                        self.manager.resources.discard(r)
+                    else:
+                        print('{}: Downloading {} failed after {} retries.'
+                              ''.format(i, r.url, retries))
+                    if checkpoint and i % checkpoint == 0:
+                        self.manager.store.commit()
+                    i += 1
+        finally:
+            downloads.shutdown()
+            images.shutdown()
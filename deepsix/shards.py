@@ -0,0 +1,313 @@
+import os
+import csv
+import json
+import random
+import collections
+import multiprocessing
+import numpy
+from . import image_filenames_as_dict
+from .data import image_shape, load_into, purposes
+
+
+def random_purpose():
+    """Return a data set drawn with probabilities 80%, 10%, and 10%."""
+    x = random.random()
+    return ('testing' if x < .1 else
+            'validation' if x < .2 else
+            'training')
+
+
+class Shard_Store:
+    """A sharded, appendable dataset of images indexed by a manifest.
+
+    Image data is stored in .npy shards holding at most shard_size images
+    each. The file manifest.csv maps each global image index to its shard,
+    offset within the shard, label, data set, and source path. Appending
+    images only writes new shards and manifest rows; existing shards are
+    never rewritten.
+
+    Attributes:
+        directory: A directory path for the shards and manifest.
+        shard_size: The maximum number of images in each shard.
+        dtype: The name of the numpy type used to store pixel data.
+        shape: The shape (3, width, height) of every image in the store.
+        sources: A list of source directory paths. The label of an image is
+            the position of its source in this list.
+        shards: The number of shards written so far.
+        manifest: A list of [index, shard, offset, label, purpose, path]
+            rows, one for each image in the store.
+    """
+
+    def __init__(self, directory, shard_size=10000, dtype='float32'):
+        """Open the store in directory, creating it if necessary.
+
+        Args:
+            directory: A directory path for the shards and manifest.
+            shard_size: The maximum number of images in each new shard.
+                Ignored if the store already exists.
+            dtype: 'float32' or 'uint8', as for Dataset. Ignored if the store
+                already exists.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.shape = None
+        self.sources = []
+        self.shards = 0
+        self.manifest = []
+        filename = os.path.join(directory, 'shards.json')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                info = json.load(f)
+            self.shard_size = info['shard_size']
+            self.dtype = info['dtype']
+            self.shape = tuple(info['shape']) if info['shape'] else None
+            self.sources = info['sources']
+            self.shards = info['shards']
+        filename = os.path.join(directory, 'manifest.csv')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                reader = csv.reader(f)
+                next(reader)  # skip the header
+                for index, shard, offset, label, purpose, path in reader:
+                    self.manifest.append([int(index), int(shard), int(offset),
+                                          int(label), purpose, path])
+
+    def __str__(self):
+        """Return a summary of the store."""
+        result = '{} images in {} shards from {} sources'.format(
+            len(self.manifest), self.shards, len(self.sources))
+        for purpose in purposes:
+            dist = [0] * len(self.sources)
+            for row in self.manifest:
+                if row[4] == purpose:
+                    dist[row[3]] += 1
+            result += '\n | {:6} for {} {}'.format(sum(dist), purpose, dist)
+        return result
+
+    def shard_path(self, shard):
+        """Return the path of the .npy file storing a shard."""
+        return os.path.join(self.directory, 'shard_{:05d}.npy'.format(shard))
+
+    def append(self, sources, processes=1, cache=None):
+        """Add the images in sources that are not yet in the store.
+
+        Images are identified by filename as in Dataset: an id already in the
+        store is skipped, and an id found in several new sources is taken from
+        one of them uniformly at random. New images are assigned to the
+        training, validation, and testing sets with probabilities 80%, 10%,
+        and 10%, decoded in parallel, and written to new shards.
+
+        Args:
+            sources: A list of directory paths containing images. A source
+                already in the store keeps its label.
+            processes: The number of worker processes decoding images.
+            cache: An Image_Cache of decoded images, as for Dataset.
+        """
+        known = set(os.path.splitext(os.path.basename(row[5]))[0]
+                    for row in self.manifest)
+        path_dictionary = {}
+        for source in sources:
+            if source not in self.sources:
+                self.sources.append(source)
+            label = self.sources.index(source)
+            for uid, path in image_filenames_as_dict(source).items():
+                if uid not in known:
+                    path_dictionary.setdefault(uid, []).append((path, label))
+        images = [random.choice(paths) for paths in path_dictionary.values()]
+        random.shuffle(images)
+        pool = multiprocessing.Pool(processes)
+        try:
+            shapes = pool.map(image_shape, [x[0] for x in images],
+                              chunksize=64)
+            if self.shape is None and shapes:
+                self.shape = collections.Counter(shapes).most_common(1)[0][0]
+            tasks = []
+            rows = []
+            for (path, label), shape in zip(images, shapes):
+                if shape != self.shape:
+                    print('{} is not {}'.format(path, self.shape))
+                    continue
+                shard, offset = divmod(len(rows), self.shard_size)
+                shard += self.shards
+                purpose = random_purpose()
+                tasks.append((self.shard_path(shard), offset, path, cache))
+                rows.append([len(self.manifest) + len(rows), shard, offset,
+                             label, purpose, path])
+            # allocate the new shards, then let the workers fill them in
+            for start in range(0, len(rows), self.shard_size):
+                shard = rows[start][1]
+                n = len(rows[start:start + self.shard_size])
+                numpy.lib.format.open_memmap(self.shard_path(shard), mode='w+',
+                                             dtype=self.dtype,
+                                             shape=(n,) + self.shape)
+            pool.map(load_into, tasks, chunksize=64)
+        finally:
+            pool.terminate()
+            pool.join()
+        if cache:
+            cache.evict()
+        self.shards += -(-len(rows) // self.shard_size)
+        self.__save(rows)
+        print('Appended {} images to {}'.format(len(rows), self.directory))
+
+    def extend(self, images, saved=None):
+        """Add images to the store as they arrive, without reading files.
+
+        Unlike append, the number of images need not be known in advance.
+        Each new shard is memory-mapped at its full size and filled in
+        order; its manifest rows are saved once it is full, and the last
+        shard is trimmed to the images it holds. Images are assigned to data
+        sets as in append.
+
+        Args:
+            images: An iterable of (image, source, path) triples: a uint8
+                array of shape (3, width, height) as returned by
+                image_array, a source directory path giving the label of the
+                image as in append, and the path recorded in the manifest.
+            saved: If given, a function called with the new manifest rows
+                each time they are saved, e.g. to record that their images
+                are safely in the store.
+
+        Return:
+            The number of images added.
+        """
+        output, rows, added = None, [], 0
+        for image, source, path in images:
+            if source not in self.sources:
+                self.sources.append(source)
+            if self.shape is None:
+                self.shape = image.shape
+            if image.shape != self.shape:
+                print('{} is not {}'.format(path, self.shape))
+                continue
+            if output is None:
+                output = numpy.lib.format.open_memmap(
+                    self.shard_path(self.shards), mode='w+',
+                    dtype=self.dtype,
+                    shape=(self.shard_size,) + self.shape)
+            offset = len(rows)
+            output[offset] = image if self.dtype == 'uint8' else image / 255.
+            rows.append([len(self.manifest) + offset, self.shards, offset,
+                         self.sources.index(source), random_purpose(), path])
+            if len(rows) == self.shard_size:
+                output.flush()
+                output = None
+                self.shards += 1
+                added += len(rows)
+                self.__save(rows)
+                if saved:
+                    saved(rows)
+                rows = []
+        if output is not None:
+            filename = self.shard_path(self.shards)
+            if rows:
+                trimmed = numpy.lib.format.open_memmap(
+                    filename + '.part', mode='w+', dtype=self.dtype,
+                    shape=(len(rows),) + self.shape)
+                trimmed[:] = output[:len(rows)]
+                trimmed.flush()
+                del trimmed, output
+                os.rename(filename + '.part', filename)
+                self.shards += 1
+                added += len(rows)
+                self.__save(rows)
+                if saved:
+                    saved(rows)
+            else:
+                del output
+                os.remove(filename)
+        print('Appended {} images to {}'.format(added, self.directory))
+        return added
+
+    def split(self, purpose):
+        """Return a (data, labels) pair for one of the data sets.
+
+        The data is a Shard_Array reading images from the memory-mapped
+        shards on demand, and the labels a numpy vector.
+        """
+        rows = [row for row in self.manifest if row[4] == purpose]
+        shards = numpy.array([row[1] for row in rows], dtype=numpy.int64)
+        offsets = numpy.array([row[2] for row in rows], dtype=numpy.int64)
+        labels = numpy.array([row[3] for row in rows], dtype=numpy.int32)
+        return Shard_Array(self, shards, offsets), labels
+
+    def __save(self, rows):
+        """Append rows to manifest.csv and update shards.json."""
+        filename = os.path.join(self.directory, 'manifest.csv')
+        new = not os.path.exists(filename)
+        with open(filename, 'a') as csvfile:
+            writer = csv.writer(csvfile)
+            if new:
+                writer.writerow(['index', 'shard', 'offset', 'label',
+                                 'purpose', 'path'])
+            writer.writerows(rows)
+        self.manifest.extend(rows)
+        filename = os.path.join(self.directory, 'shards.json')
+        with open(filename, 'w') as f:
+            json.dump({'shard_size': self.shard_size,
+                       'dtype': self.dtype,
+                       'shape': self.shape,
+                       'sources': self.sources,
+                       'shards': self.shards},
+                      f, indent=2, sort_keys=True)
+
+
+class Shard_Array:
+    """A read-only array of images spread across the shards of a store.
+
+    Supports the parts of the numpy array interface used by Prefetcher:
+    len(), shape, dtype, and take().
+
+    Attributes:
+        shape: The shape of the array, (n, 3, width, height).
+        dtype: The numpy type of the pixel data.
+    """
+
+    def __init__(self, store, shards, offsets):
+        """Initialize the array from the shard and offset of each image."""
+        self.__store = store
+        self.__shards = shards
+        self.__offsets = offsets
+        self.__open = {}
+        self.shape = (len(shards),) + tuple(store.shape or ())
+        self.dtype = numpy.dtype(store.dtype)
+
+    def __len__(self):
+        """Return the number of images in the array."""
+        return len(self.__shards)
+
+    def shuffled_indices(self):
+        """Return a random order visiting the array one shard at a time.
+
+        Consecutive minibatches drawn in this order stream through each
+        memory-mapped shard in turn instead of seeking across all of them.
+        """
+        shards = numpy.unique(self.__shards)
+        numpy.random.shuffle(shards)
+        order = []
+        for shard in shards:
+            indices = numpy.flatnonzero(self.__shards == shard)
+            numpy.random.shuffle(indices)
+            order.append(indices)
+        if not order:
+            return numpy.arange(0)
+        return numpy.concatenate(order)
+
+    def take(self, indices, axis=0, out=None, mode='raise'):
+        """Return the images at indices, as numpy.ndarray.take would."""
+        assert axis == 0
+        indices = numpy.asarray(indices)
+        if out is None:
+            out = numpy.empty((len(indices),) + self.shape[1:], self.dtype)
+        shards = self.__shards[indices]
+        offsets = self.__offsets[indices]
+        for shard in numpy.unique(shards):
+            if shard not in self.__open:
+                self.__open[shard] = numpy.load(
+                    self.__store.shard_path(shard), mmap_mode='r')
+            selected = shards == shard
+            out[selected] = self.__open[shard][offsets[selected]]
+        return out
@@ -0,0 +1,122 @@
+import os
+import json
+import sqlite3
+
+statuses = ('pending', 'ok', 'invalid', 'duplicate', 'ingested')
+
+
+class Resource_Store:
+    """An indexed on-disk store of image resources backed by sqlite.
+
+    Each resource is a row (id, url, raw, status), where status is one of
+    'pending' (not yet downloaded), 'ok' (downloaded to raw), 'invalid'
+    (the server did not return an image), 'duplicate' (the image was
+    identical to one already downloaded), or 'ingested' (the image was
+    added to a dataset by deepsix.ingest without keeping a raw copy).
+    Changes are written incrementally and become durable at each commit().
+
+    Attributes:
+        filename: The path of the sqlite database file.
+    """
+
+    def __init__(self, filename):
+        """Open the store in filename, creating it if necessary."""
+        self.filename = filename
+        self.__connection = sqlite3.connect(filename)
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS resources ('
+            'id TEXT PRIMARY KEY, url TEXT, raw TEXT, status TEXT)')
+        self.__connection.execute(
+            'CREATE INDEX IF NOT EXISTS resources_status '
+            'ON resources (status)')
+        self.__connection.commit()
+
+    def __len__(self):
+        """Return the number of resources in the store."""
+        return self.count()
+
+    def count(self, status=None):
+        """Return the number of resources, optionally with a given status."""
+        if status:
+            query = 'SELECT COUNT(*) FROM resources WHERE status = ?'
+            return self.__connection.execute(query, (status,)).fetchone()[0]
+        query = 'SELECT COUNT(*) FROM resources'
+        return self.__connection.execute(query).fetchone()[0]
+
+    def rows(self, status=None):
+        """Return an iterator of (id, url, raw, status) rows.
+
+        Args:
+            status: If given, only rows with this status are returned, e.g.
+                'pending' for the resources not yet downloaded.
+        """
+        if status:
+            return self.__connection.execute(
+                'SELECT id, url, raw, status FROM resources '
+                'WHERE status = ?', (status,))
+        return self.__connection.execute(
+            'SELECT id, url, raw, status FROM resources')
+
+    def add(self, resources):
+        """Add new resources as pending, leaving existing ones untouched."""
+        self.__connection.executemany(
+            'INSERT OR IGNORE INTO resources VALUES (?, ?, ?, ?)',
+            ((r.id, r.url, r.raw, 'ok' if r.raw else 'pending')
+             for r in resources))
+
+    def update(self, resource, status=None):
+        """Insert or replace the url, raw path, and status of a resource.
+
+        Args:
+            resource: An Image_Resource.
+            status: The new status; by default, 'ok' if the resource has a
+                raw path and 'pending' otherwise.
+        """
+        if status is None:
+            status = 'ok' if resource.raw else 'pending'
+        assert status in statuses
+        self.__connection.execute(
+            'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?)',
+            (resource.id, resource.url, resource.raw, status))
+
+    def commit(self):
+        """Write all changes to disk."""
+        self.__connection.commit()
+
+    def close(self):
+        """Commit all changes and close the database."""
+        self.__connection.commit()
+        self.__connection.close()
+
+    def import_json(self, filename, directory):
+        """Import resources from a resources.json file of an Image_Manager.
+
+        As in the JSON format, a raw path that no longer exists is replaced
+        by directory/raw/<id>.jpeg if that exists, and cleared otherwise.
+        """
+        with open(filename) as f:
+            existing_resources = json.load(f)
+        rows = []
+        for key, paths in existing_resources.items():
+            url = paths[0]
+            default_raw = os.path.join(directory, 'raw', key + '.jpeg')
+            if os.path.exists(paths[1]):
+                raw = paths[1]
+            elif os.path.exists(default_raw):
+                raw = default_raw
+            else:
+                raw = ''
+            rows.append((key, url, raw, 'ok' if raw else 'pending'))
+        self.__connection.executemany(
+            'INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?)', rows)
+        self.__connection.commit()
+
+    def export_json(self, filename):
+        """Export the valid resources in the resources.json format."""
+        with open(filename, 'w') as f:
+            json.dump(
+                {uid: [url, raw] for uid, url, raw, status in self.rows()
+                 if status not in ('invalid', 'duplicate')},
+                f,
+                indent=2,
+                sort_keys=True)
@@ -0,0 +1,159 @@
+import os
+import csv
+import json
+import itertools
+import multiprocessing
+import numbers
+
+thread_variables = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS')
+
+
+def grid(**parameters):
+    """Return every combination of the given parameter values.
+
+    For example, grid(learning_rate=[.01, .001], momentum=[.1, .9]) returns
+    four dictionaries of keyword arguments for Experiment.
+    """
+    keys = sorted(parameters)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*(parameters[x] for x in keys))]
+
+
+def _run_experiment(task):
+    """Train, test, and save one experiment of a sweep in a worker process.
+
+    Return:
+        A pair of the output directory and an error message, or None if the
+        experiment succeeded.
+    """
+    data, directory, network, configuration, epochs, train_kwargs = task
+    try:
+        # imported here so that theano starts after the thread limits are set
+        from .experiment import Experiment
+        experiment = Experiment(data=data, directory=directory,
+                                network=network, mmap_mode='r',
+                                **configuration)
+        experiment.train(epochs, **train_kwargs)
+        experiment.test()
+        experiment.save()
+    except Exception as e:
+        return directory, '{}: {}'.format(type(e).__name__, e)
+    return directory, None
+
+
+def run(data, directory, network, configurations, epochs=10, processes=None,
+        threads=None, **train_kwargs):
+    """Train one experiment for each configuration in parallel.
+
+    Each worker process trains one experiment at a time, reading the data
+    set through read-only memory maps, so the workers share a single copy of
+    the data in the page cache. The number of threads used by each worker
+    for linear algebra is limited so that the workers do not compete for
+    cores. Workers are started fresh rather than forked, so that Theano and
+    BLAS start up with these limits even if the caller imported them.
+
+    Args:
+        data: The path of the directory containing the dataset .npy files.
+        directory: The directory path to save the output of the sweep. The
+            output of each experiment is saved in a numbered subdirectory.
+        network: A function returning the output layer of a Lasagne neural
+            network, as for Experiment. It must be importable by the workers,
+            i.e. defined at the top level of a module.
+        configurations: A list of dictionaries of keyword arguments for
+            Experiment, e.g. from grid().
+        epochs: The maximum number of epochs to train each network for.
+        processes: The number of worker processes; by default, one for each
+            core or configuration, whichever is fewer.
+        threads: The number of threads of each worker; by default, the cores
+            are divided evenly among the workers.
+        **train_kwargs: Passed to Experiment.train.
+
+    Return:
+        The rows of the comparison table written by gather().
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    cores = multiprocessing.cpu_count()
+    processes = processes or min(cores, len(configurations))
+    threads = threads or max(cores // processes, 1)
+    tasks = [(data, os.path.join(directory, 'run_{:03d}'.format(i)), network,
+              configuration, epochs, train_kwargs)
+             for i, configuration in enumerate(configurations)]
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+    else:
+        context = multiprocessing
+    # workers inherit the environment when they start
+    saved = dict((x, os.environ.get(x)) for x in thread_variables)
+    for x in thread_variables:
+        os.environ[x] = str(threads)
+    try:
+        pool = context.Pool(processes)
+    finally:
+        for x, value in saved.items():
+            if value is None:
+                del os.environ[x]
+            else:
+                os.environ[x] = value
+    errors = {}
+    for run_directory, error in pool.imap_unordered(_run_experiment, tasks):
+        if error:
+            errors[os.path.basename(run_directory)] = error
+            print('Failed {}: {}'.format(run_directory, error))
+        else:
+            print('Finished {}'.format(run_directory))
+    pool.close()
+    pool.join()
+    return gather(directory, errors)
+
+
+def gather(directory, errors=None):
+    """Collect the results of a sweep into one comparison table.
+
+    Every subdirectory of directory holding an experiment.json gives one row
+    of sweep.csv in directory, with a column for each number or string in
+    the report (except the network source), and the final training and
+    validation loss and accuracy from training_progress.csv.
+
+    Args:
+        directory: The output directory of a sweep.
+        errors: An optional dictionary mapping run names to error messages,
+            recorded in an error column.
+
+    Return:
+        The rows of the table, as dictionaries.
+    """
+    errors = errors or {}
+    rows = []
+    for name in sorted(set(os.listdir(directory)) | set(errors)):
+        filename = os.path.join(directory, name, 'experiment.json')
+        if name in errors:
+            rows.append({'run': name, 'error': errors[name]})
+            continue
+        if not os.path.exists(filename):
+            continue
+        with open(filename) as f:
+            report = json.load(f)
+        row = {'run': name}
+        for key, value in report.items():
+            if key != 'network' and isinstance(value, (numbers.Number,
+                                                       str)):
+                row[key] = value
+        filename = os.path.join(directory, name, 'training_progress.csv')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                history = list(csv.reader(f))
+            if len(history) > 1:
+                for key in ('Trn_Loss', 'Trn_Acc', 'Val_Loss', 'Val_Acc'):
+                    row['final_' + key] = history[-1][history[0].index(key)]
+        rows.append(row)
+    columns = ['run'] + sorted(set(key for row in rows for key in row) -
+                               set(['run']))
+    with open(os.path.join(directory, 'sweep.csv'), 'w') as csvfile:
+        writer = csv.DictWriter(csvfile, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Compared {} experiments > {}'.format(
+        len(rows), os.path.join(directory, 'sweep.csv')))
+    return rows
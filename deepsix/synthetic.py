@@ -0,0 +1,161 @@
+import os
+import json
+import numpy
+from .augment import paste_squares
+from .data import purposes
+
+backgrounds = ('black', 'solid')
+
+
+def parameters(number, size=64, square=16, background='solid', seed=0):
+    """Draw the parameters of a reproducible set of synthetic images.
+
+    Like artificial.py, each image has a solid background (black, or a
+    random colour), and about half of the images have a white square at a
+    random position; these are labelled 1 and the others 0. Only these few
+    numbers are stored for each image, not its pixels.
+
+    Args:
+        number: The number of images.
+        size: The width and height of each image.
+        square: The width and height of the squares.
+        background: 'black' or 'solid'.
+        seed: The seed of the random number generator.
+
+    Return:
+        A tuple (colours, corners, labels) of a uint8 array of shape
+        (number, 3), an int64 array of shape (number, 2) holding the top-left
+        corner of each square, and an int32 vector.
+    """
+    if background not in backgrounds:
+        raise ValueError('Unsupported background {}.'.format(background))
+    random = numpy.random.RandomState(seed)
+    if background == 'black':
+        colours = numpy.zeros((number, 3), dtype=numpy.uint8)
+    else:
+        colours = random.randint(255, size=(number, 3)).astype(numpy.uint8)
+    corners = random.randint(size - square, size=(number, 2))
+    labels = random.randint(2, size=number).astype(numpy.int32)
+    return colours, corners, labels
+
+
+def render(colours, corners, labels, size=64, square=16, out=None):
+    """Draw a batch of synthetic images from their parameters.
+
+    Return:
+        A uint8 array of shape (n, 3, size, size) laid out like load_image,
+        written to out if given.
+    """
+    if out is None:
+        out = numpy.empty((len(colours), 3, size, size), dtype=numpy.uint8)
+    out[...] = colours[:, :, None, None]
+    chosen = numpy.flatnonzero(labels)
+    paste_squares(out, chosen, corners[chosen, 0], corners[chosen, 1],
+                  square, 255)
+    return out
+
+
+class Synthetic_Array:
+    """A read-only array of synthetic images drawn on demand.
+
+    Only the parameters of each image are kept in memory, so the array can
+    hold millions of images and be passed to Experiment (through Prefetcher)
+    in place of image data read from disk. It supports len(), shape, dtype,
+    and take() like Shard_Array.
+
+    Attributes:
+        shape: The shape of the array, (n, 3, size, size).
+        dtype: The numpy type of the pixel data, uint8 or float32.
+    """
+
+    def __init__(self, colours, corners, labels, size=64, square=16,
+                 dtype='uint8'):
+        """Initialize the array from the parameters of each image."""
+        self.__colours = colours
+        self.__corners = corners
+        self.__labels = labels
+        self.__size = size
+        self.__square = square
+        self.shape = (len(labels), 3, size, size)
+        self.dtype = numpy.dtype(dtype)
+
+    def __len__(self):
+        """Return the number of images in the array."""
+        return len(self.__labels)
+
+    def take(self, indices, axis=0, out=None, mode='raise'):
+        """Return the images at indices, as numpy.ndarray.take would."""
+        assert axis == 0
+        indices = numpy.asarray(indices)
+        images = render(self.__colours[indices], self.__corners[indices],
+                        self.__labels[indices], self.__size, self.__square,
+                        out if self.dtype == numpy.uint8 else None)
+        if self.dtype == numpy.uint8:
+            return images
+        if out is None:
+            out = numpy.empty(images.shape, self.dtype)
+        return numpy.divide(images, 255, out=out, dtype=self.dtype)
+
+
+def generate(number, size=64, square=16, background='solid', seed=0,
+             dtype='uint8'):
+    """Return the training, validation, and testing sets of synthetic data.
+
+    The first 10% of the images are used for testing and the next 10% for
+    validation, as in Dataset. The result can be passed to Experiment as its
+    data to train on millions of images without writing any files.
+
+    Return:
+        A dictionary mapping each purpose to a (Synthetic_Array, labels)
+        pair.
+    """
+    colours, corners, labels = parameters(number, size, square, background,
+                                          seed)
+    parts = {'training': slice(2*(number//10), number),
+             'validation': slice(number//10, 2*(number//10)),
+             'testing': slice(number//10)}
+    return {part: (Synthetic_Array(colours[s], corners[s], labels[s], size,
+                                   square, dtype),
+                   labels[s])
+            for part, s in parts.items()}
+
+
+def save_dataset(directory, number, size=64, square=16, background='solid',
+                 seed=0, dtype='float32', chunk=10000):
+    """Write a synthetic data set in the output format of Dataset.
+
+    The images are drawn chunk at a time straight into the .npy files, so
+    memory use does not depend on the number of images, and the result can
+    be read by Experiment like a dataset made by mkdata.py.
+
+    Args:
+        directory: A directory path for the output files.
+        number: The number of images.
+        size, square, background, seed: As for parameters().
+        dtype: 'float32' or 'uint8', as for Dataset.
+        chunk: The number of images drawn at once.
+    """
+    if dtype not in ('float32', 'uint8'):
+        raise ValueError('Unsupported dtype {}.'.format(dtype))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    sets = generate(number, size, square, background, seed, dtype)
+    for part in purposes:
+        data, labels = sets[part]
+        data_file = os.path.join(directory, part + '_data.npy')
+        output = numpy.lib.format.open_memmap(data_file, mode='w+',
+                                              dtype=dtype, shape=data.shape)
+        for start in range(0, len(data), chunk):
+            stop = min(start + chunk, len(data))
+            data.take(numpy.arange(start, stop), out=output[start:stop])
+        output.flush()
+        print('Saved array {!s:22} > {}'.format(output.shape, data_file))
+        labels_file = os.path.join(directory, part + '_labels.npy')
+        numpy.save(labels_file, labels)
+        print('Saved array {!s:22} > {}'.format(labels.shape, labels_file))
+    save_data = {'sources': ['synthetic:' + background],
+                 'dtype': dtype,
+                 'paths': [],
+                 'seed': seed}
+    with open(os.path.join(directory, 'datasets.json'), 'w') as f:
+        json.dump(save_data, f)
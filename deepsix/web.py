@@ -0,0 +1,62 @@
+"""HTTP sessions for downloading images.
+
+This module imports requests, so it is only imported by the parts of deepsix
+that download, and other commands start without it.
+"""
+import time
+import threading
+import requests
+
+requests.packages.urllib3.disable_warnings()
+
+# the errors after which a download is worth retrying; Image_Resource
+# raises HTTPError only for server errors (5xx)
+transient_errors = (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError)
+
+
+class Rate_Limited_Adapter(requests.adapters.HTTPAdapter):
+    """A transport adapter spacing out the requests sent to each host.
+
+    Attributes:
+        interval: The minimum number of seconds between two requests to the
+            same host.
+    """
+
+    def __init__(self, rate=None, **kwargs):
+        """Initialize the adapter with a maximum rate in requests/second."""
+        self.interval = 1. / rate if rate else 0.
+        self.__lock = threading.Lock()
+        self.__next = {}
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        """Wait for the host's next free slot, then send the request."""
+        if self.interval:
+            host = requests.compat.urlparse(request.url).netloc
+            with self.__lock:
+                now = time.time()
+                start = max(now, self.__next.get(host, now))
+                self.__next[host] = start + self.interval
+            if start > now:
+                time.sleep(start - now)
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+
+def pooled_session(workers=1, rate_limit=None):
+    """Return a requests.Session pooling connections for several threads.
+
+    Args:
+        workers: The number of threads that will share the session.
+        rate_limit: The maximum number of requests per second sent to any one
+            host, or None for no limit.
+    """
+    session = requests.Session()
+    adapter = Rate_Limited_Adapter(rate=rate_limit,
+                                   pool_connections=workers,
+                                   pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -9,8 +9,7 @@ tags = ['nikon', 'canon', 'iphone', 'raw', 'photography', 'photos', 'photo',
         'party', 'people', 'sky', 'snow', 'street', 'sunset', 'travel',
         'trees', 'vacation', 'water', 'winter', 'spring', 'summer', 'autumn',
         'australia', 'canada',  'china', 'europe', 'india', 'japan', 'usa']
-for tag in tags:
-    print('Finding images tagged \'{}\'... '.format(tag))
-    flickr.add_resources(maximum=5000, tags=tag)
-flickr.download_all()
+flickr.discover_and_download(queries=[{'tags': tag} for tag in tags],
+                             maximum=5000, discovery_workers=8,
+                             workers=16, rate_limit=20)
 flickr.save()
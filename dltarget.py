@@ -3,5 +3,5 @@ import time
 
 flickr = Target_Manager(directory='images/target')
 flickr.add_resources(maximum=10000, filename='api_target_skus.txt', size=64)
-flickr.download_all()
+flickr.download_all(workers=16, rate_limit=20)
 flickr.save()
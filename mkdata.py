@@ -1,11 +1,22 @@
+import os
 import sys
+import multiprocessing
 from deepsix.data import Dataset
+from deepsix.cache import Image_Cache
 
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print('Usage: python3 path/to/dir1 path/to/dir2 path/to/output')
+    args = [x for x in sys.argv[1:] if x != '--cache']
+    if len(args) not in (3, 4):
+        print('Usage: python3 mkdata.py [--cache] path/to/dir1 path/to/dir2 '
+              'path/to/output [float32|uint8]')
         exit()
-    a = Dataset(sys.argv[3], [sys.argv[1], sys.argv[2]])
+    dtype = 'float32' if len(args) == 3 else args[3]
+    a = Dataset(args[2], [args[0], args[1]], dtype=dtype)
     print(str(a) + '\n')
-    a.load_images()
+    cache = None
+    if '--cache' in sys.argv:
+        # shared by every dataset built from the same images
+        cache = Image_Cache(os.path.join(os.path.expanduser('~'), '.cache',
+                                         'deepsix', 'images'))
+    a.load_images(processes=multiprocessing.cpu_count(), cache=cache)
     a.save()
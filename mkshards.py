@@ -0,0 +1,12 @@
+import sys
+import multiprocessing
+from deepsix.shards import Shard_Store
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python3 mkshards.py path/to/output path/to/dir1 '
+              '[path/to/dir2 ...]')
+        exit()
+    store = Shard_Store(sys.argv[1])
+    store.append(sys.argv[2:], processes=multiprocessing.cpu_count())
+    print(store)
@@ -0,0 +1,39 @@
+import os
+import sys
+import multiprocessing
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    use_numpy = False
+    batchsize = 1000
+    while args[:1] in (['--numpy'], ['--batchsize']):
+        if args[0] == '--numpy':
+            use_numpy = True
+            args = args[1:]
+        else:
+            batchsize = int(args[1])
+            args = args[2:]
+    if len(args) < 3:
+        print('Usage: python3 predict.py [--numpy] [--batchsize N] '
+              'path/to/learned_parameters.npy '
+              'path/to/output.csv path/to/dir1 [path/to/dir2 ...]')
+        exit()
+    directory = os.path.dirname(os.path.abspath(args[0]))
+    processes = multiprocessing.cpu_count()
+    if use_numpy:
+        # score with NumPy alone, using the network.json saved with the
+        # parameters, without importing Theano
+        from deepsix.inference import Inference_Network
+        network = Inference_Network.load(
+            os.path.join(directory, 'network.json'), args[0])
+        network.predict_directories(args[2:], args[1], batchsize=batchsize,
+                                    processes=processes)
+        exit()
+    from deepsix.experiment import Experiment
+    from runexperiment import network
+    cache_directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                   'deepsix')
+    exp = Experiment(data=None, directory=directory, network=network,
+                     cache_directory=cache_directory)
+    exp.load_parameters(args[0])
+    exp.predict(args[2:], args[1], batchsize=batchsize, processes=processes)
@@ -1,3 +1,4 @@
+import os
 import sys
 import lasagne
 from deepsix.experiment import Experiment
@@ -29,10 +30,15 @@ def network(input_var=None):
 
 if __name__ == '__main__':
     if len(sys.argv) < 4:
-        print('Usage: python3 path/to/data_dir path/to/output_dir n_epochs')
+        print('Usage: python3 path/to/data_dir path/to/output_dir n_epochs '
+              '[patience]')
         exit()
-    exp = Experiment(data=sys.argv[1], directory=sys.argv[2], network=network)
+    cache_directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                   'deepsix')
+    exp = Experiment(data=sys.argv[1], directory=sys.argv[2], network=network,
+                     cache_directory=cache_directory)
     n = 10 if len(sys.argv) == 3 else int(sys.argv[3])
-    exp.train(epochs=n)
+    patience = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    exp.train(epochs=n, patience=patience)
     exp.test()
     exp.save()
@@ -0,0 +1,20 @@
+import os
+import sys
+from deepsix import sweep
+from runexperiment import network
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (6, 7):
+        print('Usage: python3 sweep.py path/to/data_dir path/to/output_dir '
+              'n_epochs learning_rate[,...] momentum[,...] [processes]')
+        exit()
+    configurations = sweep.grid(
+        learning_rate=[float(x) for x in sys.argv[4].split(',')],
+        momentum=[float(x) for x in sys.argv[5].split(',')])
+    cache_directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                   'deepsix')
+    for configuration in configurations:
+        configuration['cache_directory'] = cache_directory
+    processes = int(sys.argv[6]) if len(sys.argv) == 7 else None
+    sweep.run(sys.argv[1], sys.argv[2], network, configurations,
+              epochs=int(sys.argv[3]), processes=processes)
@@ -1,3 +1,4 @@
+import os
 import sys
 import lasagne
 from deepsix.experiment import Experiment
@@ -31,7 +32,10 @@ if __name__ == '__main__':
     if len(sys.argv) < 3:
         print('Usage: python3 path/to/data_dir path/to/experiment_dir')
         exit()
-    exp = Experiment(data=sys.argv[1], directory=sys.argv[2], network=network)
+    cache_directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                   'deepsix')
+    exp = Experiment(data=sys.argv[1], directory=sys.argv[2], network=network,
+                     mmap_mode='r', cache_directory=cache_directory)
     if len(sys.argv) < 4:
         exp.load_parameters()
     else:
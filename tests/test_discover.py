@@ -0,0 +1,63 @@
+"""Test Image_Manager.discover with a stand-in for the Flickr API."""
+import pytest
+from deepsix.images import Flickr_Manager
+
+photos = {
+    'cat': ['1', '2', '3', '4'],
+    'dog': ['3', '4', '5', '6'],
+}
+
+
+class Stub_API:
+    """A stand-in for flickrapi.FlickrAPI serving photos by tag."""
+
+    def __init__(self, key, secret):
+        assert (key, secret) == ('key', 'secret')
+
+    def walk(self, tag_mode, tags, per_page):
+        if tags == 'broken':
+            yield {'id': '99', 'farm': '1', 'server': '1', 'secret': 's'}
+            raise IOError('connection reset')
+        for id in photos[tags]:
+            yield {'id': id, 'farm': '1', 'server': '1', 'secret': 's'}
+
+
+@pytest.fixture
+def manager(tmpdir):
+    api_key = tmpdir.join('api_flickr.txt')
+    api_key.write('key\nsecret\n')
+    return Flickr_Manager(str(api_key), str(tmpdir.join('images')),
+                          api=Stub_API)
+
+
+def test_resources_are_deduplicated_across_queries(manager):
+    found = [r.id for r in manager.discover([{'tags': 'cat'},
+                                             {'tags': 'dog'}], 10)]
+    assert sorted(found) == ['1', '2', '3', '4', '5', '6']
+    assert sorted(r.id for r in manager.resources) == sorted(found)
+    pending = [row[0] for row in manager.store.rows('pending')]
+    assert sorted(pending) == sorted(found)
+
+
+def test_resources_in_the_store_are_skipped(manager):
+    list(manager.discover([{'tags': 'cat'}], 10))
+    for r in manager.resources:
+        if r.id in ('1', '2'):
+            manager.store.update(r, 'invalid')
+    manager.store.commit()
+    # only resources still pending are yielded again
+    found = [r.id for r in manager.discover([{'tags': 'cat'},
+                                             {'tags': 'dog'}], 10)]
+    assert sorted(found) == ['3', '4', '5', '6']
+
+
+def test_each_query_is_capped_at_maximum(manager):
+    found = [r.id for r in manager.discover([{'tags': 'cat'}], 2)]
+    assert found == ['1', '2']
+
+
+def test_a_failing_query_does_not_stop_the_others(manager):
+    found = [r.id for r in manager.discover([{'tags': 'broken'},
+                                             {'tags': 'dog'}], 10)]
+    # discover returns instead of waiting forever for the failed query
+    assert sorted(found) == ['3', '4', '5', '6', '99']
@@ -0,0 +1,93 @@
+"""Test Image_Manager.download against a local stand-in image host."""
+import os
+import pytest
+from deepsix import benchmark
+from deepsix.images import Image_Manager
+
+
+@pytest.fixture
+def source(tmpdir):
+    """A directory of five synthetic JPEG images and one text file."""
+    directory = str(tmpdir.join('source'))
+    benchmark.synthetic_images(directory, 5, size=16)
+    with open(os.path.join(directory, 'note.txt'), 'w') as f:
+        f.write('not an image')
+    return directory
+
+
+def manager_for(directory, url, names):
+    """Return an Image_Manager with a resource for each served file."""
+    manager = Image_Manager(directory)
+    for name in names:
+        manager.resources.add(manager.Image_Resource(
+            id=os.path.splitext(name)[0], url='{}/{}'.format(url, name)))
+    manager.save()
+    return manager
+
+
+def statuses(manager):
+    return dict((row[0], row[3]) for row in manager.store.rows())
+
+
+def test_server_errors_are_retried(tmpdir, source):
+    server = benchmark.Local_Server(source, {'0.jpeg': ['error', 'error']})
+    manager = manager_for(str(tmpdir.join('images')), server.url,
+                          ['0.jpeg'])
+    manager.download_all(retries=3, backoff=0)
+    server.close()
+    assert statuses(manager) == {'0': 'ok'}
+    assert [name for _, name in server.requests] == ['0.jpeg'] * 3
+
+
+def test_interrupted_download_leaves_no_partial_file(tmpdir, source):
+    server = benchmark.Local_Server(source, {'1.jpeg': ['truncate']})
+    directory = str(tmpdir.join('images'))
+    manager = manager_for(directory, server.url, ['1.jpeg'])
+    manager.download_all(retries=1, backoff=0)
+    server.close()
+    assert statuses(manager) == {'1': 'ok'}
+    assert len(server.requests) == 2
+    assert os.listdir(os.path.join(directory, 'raw')) == ['1.jpeg']
+    with open(os.path.join(directory, 'raw', '1.jpeg'), 'rb') as f:
+        with open(os.path.join(source, '1.jpeg'), 'rb') as g:
+            assert f.read() == g.read()
+
+
+def test_non_image_response_is_invalid(tmpdir, source):
+    server = benchmark.Local_Server(source)
+    directory = str(tmpdir.join('images'))
+    manager = manager_for(directory, server.url, ['note.txt', '2.jpeg'])
+    manager.download_all(retries=0)
+    server.close()
+    assert statuses(manager) == {'note': 'invalid', '2': 'ok'}
+    assert os.listdir(os.path.join(directory, 'raw')) == ['2.jpeg']
+    assert [r.id for r in manager.resources] == ['2']
+
+
+def test_requests_to_one_host_are_rate_limited(tmpdir, source):
+    server = benchmark.Local_Server(source)
+    names = ['{}.jpeg'.format(i) for i in range(5)]
+    manager = manager_for(str(tmpdir.join('images')), server.url, names)
+    manager.download_all(workers=5, rate_limit=20)
+    server.close()
+    times = sorted(t for t, _ in server.requests)
+    assert len(times) == 5
+    # 20 requests per second, with a little slack for timer resolution
+    assert min(b - a for a, b in zip(times, times[1:])) > .04
+
+
+def test_failed_downloads_resume_from_the_store(tmpdir, source):
+    faults = {'3.jpeg': ['error', 'error']}
+    server = benchmark.Local_Server(source, faults)
+    directory = str(tmpdir.join('images'))
+    names = ['{}.jpeg'.format(i) for i in range(5)]
+    manager = manager_for(directory, server.url, names)
+    manager.download_all(retries=1, backoff=0, checkpoint=1)
+    assert statuses(manager)['3'] == 'pending'
+    # a new manager resumes only the download left pending
+    del server.requests[:]
+    manager = Image_Manager(directory)
+    manager.download_all(retries=1, backoff=0)
+    server.close()
+    assert [name for _, name in server.requests] == ['3.jpeg']
+    assert set(statuses(manager).values()) == set(['ok'])
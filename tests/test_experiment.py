@@ -0,0 +1,75 @@
+"""Test Experiment.train with plain functions in place of the network."""
+import sys
+import numpy
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+stand_ins = ('theano', 'theano.tensor', 'lasagne', 'lasagne.layers',
+             'lasagne.objectives', 'lasagne.updates', 'lasagne.nonlinearities')
+
+
+@pytest.fixture
+def experiment(monkeypatch):
+    """The deepsix.experiment module, importable without Theano.
+
+    Only the training loop is exercised, so if Theano or Lasagne is not
+    installed, stand-ins are imported in their place for this test.
+    """
+    try:
+        import theano
+        import lasagne
+    except ImportError:
+        for name in stand_ins:
+            monkeypatch.setitem(sys.modules, name, mock.MagicMock())
+        monkeypatch.delitem(sys.modules, 'deepsix.experiment', raising=False)
+    import deepsix.experiment as module
+    monkeypatch.setattr(module, 'lasagne', mock.MagicMock())
+    yield module
+    if isinstance(module.theano, mock.MagicMock):
+        # do not leave the module built on stand-ins behind
+        sys.modules.pop('deepsix.experiment', None)
+        import deepsix
+        del deepsix.experiment
+
+
+def data(n):
+    return (numpy.zeros((n, 3, 8, 8), numpy.float32),
+            numpy.zeros(n, numpy.int32))
+
+
+def test_train_with_a_plain_function_augmentation(experiment, tmpdir,
+                                                   monkeypatch):
+    batches = {'training': 0, 'validation': 0}
+
+    def compile_model(self, network, **kwargs):
+        # each function returns loss, correct, selected, relevant, and hits
+        def train_fn(inputs, targets):
+            batches['training'] += 1
+            assert (inputs == 1).all()
+            return .5, len(targets), 1, 1, 1
+
+        def val_fn(inputs, targets):
+            batches['validation'] += 1
+            assert (inputs == 0).all()
+            return .5, len(targets), 1, 1, 1
+        self._Experiment__network = None
+        self._Experiment__train_fn = train_fn
+        self._Experiment__val_fn = val_fn
+
+    def fill(inputs, targets, random):
+        inputs[:] = 1
+
+    monkeypatch.setattr(experiment.Experiment,
+                        '_Experiment__compile_model', compile_model)
+    e = experiment.Experiment(
+        data={'training': data(200), 'validation': data(100),
+              'testing': data(100)},
+        directory=str(tmpdir), network=None, augmentations=[fill])
+    e.train(1)
+    # a plain function only augments the training batches
+    assert batches == {'training': 2, 'validation': 1}
+    assert e.report['epochs'] == 1
+    assert e.history[-1][4] == 1.  # training accuracy
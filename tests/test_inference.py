@@ -0,0 +1,44 @@
+"""Test the NumPy layers of deepsix.inference on small fixed arrays."""
+import numpy
+from deepsix.inference import conv2d, max_pool
+
+
+def test_conv2d_flips_the_filters():
+    inputs = numpy.arange(9.).reshape(1, 1, 3, 3)
+    # flipped, this filter picks the bottom right pixel of each window
+    W = numpy.array([[[[1., 0.], [0., 0.]]]])
+    output = conv2d(inputs, W, numpy.array([.5]))
+    assert output.shape == (1, 1, 2, 2)
+    numpy.testing.assert_allclose(output[0, 0], [[4.5, 5.5], [7.5, 8.5]])
+
+
+def test_conv2d_sums_over_channels():
+    inputs = numpy.stack([numpy.arange(9.).reshape(3, 3),
+                          numpy.ones((3, 3)),
+                          -numpy.arange(9.).reshape(3, 3)])[numpy.newaxis]
+    W = numpy.zeros((2, 3, 2, 2))
+    W[0, 0] = [[1., 2.], [3., 4.]]
+    W[0, 1] = 1.
+    W[1, 2] = [[0., 0.], [0., 1.]]
+    output = conv2d(inputs, W, numpy.zeros(2))
+    assert output.shape == (1, 2, 2, 2)
+    # e.g. top left: 0*4 + 1*3 + 3*2 + 4*1 from channel 0, 4 from channel 1
+    numpy.testing.assert_allclose(output[0, 0], [[17., 27.], [47., 57.]])
+    # the flipped filter picks the top left pixel of each window
+    numpy.testing.assert_allclose(output[0, 1], [[0., -1.], [-3., -4.]])
+
+
+def test_max_pool_drops_partial_pools():
+    inputs = numpy.arange(20.).reshape(1, 1, 4, 5)
+    inputs[0, 0, 0, 0] = 100.
+    inputs[0, 0, 3, 4] = 200.  # in the last column, which is dropped
+    output = max_pool(inputs, (2, 2))
+    assert output.shape == (1, 1, 2, 2)
+    numpy.testing.assert_allclose(output[0, 0], [[100., 8.], [16., 18.]])
+
+
+def test_max_pool_keeps_channels_apart():
+    inputs = numpy.stack([numpy.arange(4.).reshape(2, 2),
+                          -numpy.arange(4.).reshape(2, 2)])[numpy.newaxis]
+    output = max_pool(inputs, (2, 2))
+    numpy.testing.assert_allclose(output.ravel(), [3., 0.])
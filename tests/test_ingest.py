@@ -0,0 +1,71 @@
+"""Test Ingest_Pipeline against a local stand-in image host."""
+import collections
+import pytest
+from deepsix import benchmark
+from deepsix.images import Image_Manager, add_square
+from deepsix.ingest import Ingest_Pipeline
+from deepsix.shards import Shard_Store
+
+
+@pytest.fixture
+def server(tmpdir):
+    source = str(tmpdir.join('source'))
+    benchmark.synthetic_images(source, 12, size=32)
+    server = benchmark.Local_Server(source)
+    yield server
+    server.close()
+
+
+def manager_for(directory, url, number):
+    manager = Image_Manager(directory)
+    for i in range(number):
+        manager.resources.add(manager.Image_Resource(
+            id=str(i), url='{}/{}.jpeg'.format(url, i)))
+    manager.save()
+    return manager
+
+
+def statuses(manager):
+    return collections.Counter(row[3] for row in manager.store.rows())
+
+
+def test_interrupted_ingest_resumes(tmpdir, server):
+    images = str(tmpdir.join('images'))
+    data = str(tmpdir.join('data'))
+    manager = manager_for(images, server.url, 12)
+
+    def interrupted():
+        for r in sorted(manager.resources, key=lambda r: int(r.id))[:10]:
+            yield r
+        raise KeyboardInterrupt
+
+    # with at most two images in flight, at least nine of the first ten
+    # are processed before the interruption
+    with pytest.raises(KeyboardInterrupt):
+        Ingest_Pipeline(manager, Shard_Store(data, shard_size=4), 16).run(
+            interrupted(), workers=2, threads=2, queue_size=2)
+    # only the images in the two full shards were saved
+    manager = Image_Manager(images)
+    store = Shard_Store(data)
+    assert len(store.manifest) == 8
+    assert statuses(manager) == {'ingested': 8, 'pending': 4}
+    # a second run ingests the rest, and skips the images in the store
+    Ingest_Pipeline(manager, store, 16).run(workers=2, threads=2)
+    manager = Image_Manager(images)
+    store = Shard_Store(data)
+    assert statuses(manager) == {'ingested': 12}
+    assert len(store.manifest) == 12 and store.shards == 3
+    assert len(set(row[5] for row in store.manifest)) == 12
+
+
+def test_images_too_small_to_alter_are_invalid(tmpdir, server):
+    manager = manager_for(str(tmpdir.join('images')), server.url, 12)
+    store = Shard_Store(str(tmpdir.join('data')))
+    # a 16x16 square does not fit in an 8x8 image
+    pipeline = Ingest_Pipeline(manager, store, 8,
+                               versions=[('square', add_square)])
+    added = pipeline.run(workers=2, threads=2)
+    counts = statuses(manager)
+    assert added == counts['ingested'] == len(store.manifest)
+    assert counts['ingested'] + counts['invalid'] == 12
+    assert all(row[5].split('/')[-2] == '8' for row in store.manifest)
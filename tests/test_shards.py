@@ -0,0 +1,51 @@
+"""Test Shard_Store.extend with numbers of images around the shard size."""
+import os
+import numpy
+import pytest
+from deepsix.shards import Shard_Store
+
+
+def images(n, source='source'):
+    for i in range(n):
+        image = numpy.full((3, 4, 4), i, numpy.uint8)
+        yield image, source, '{}/{}.bmp'.format(source, i)
+
+
+@pytest.mark.parametrize('n,shards', [(3, 1), (4, 1), (5, 2), (8, 2)])
+def test_extend_fills_and_trims_shards(tmpdir, n, shards):
+    directory = str(tmpdir)
+    store = Shard_Store(directory, shard_size=4, dtype='uint8')
+    saved = []
+    assert store.extend(images(n), saved.append) == n
+    assert store.shards == shards
+    assert sorted(os.listdir(directory)) == sorted(
+        ['manifest.csv', 'shards.json'] +
+        ['shard_{:05d}.npy'.format(i) for i in range(shards)])
+    assert [len(rows) for rows in saved] == [4] * (n // 4) + (
+        [n % 4] if n % 4 else [])
+    # the last shard holds only the images written to it
+    sizes = [len(numpy.load(store.shard_path(i))) for i in range(shards)]
+    assert sizes == [len(rows) for rows in saved]
+    # a store opened again reads back every image in order
+    store = Shard_Store(directory)
+    assert [row[0] for row in store.manifest] == list(range(n))
+    data, _ = store.split('training')
+    rows = [row for row in store.manifest if row[4] == 'training']
+    assert [int(x[0, 0, 0]) for x in data.take(range(len(rows)))] == [
+        int(os.path.splitext(os.path.basename(row[5]))[0]) for row in rows]
+
+
+def test_extend_with_no_images_writes_no_shard(tmpdir):
+    store = Shard_Store(str(tmpdir), shard_size=4)
+    assert store.extend(images(0)) == 0
+    assert store.shards == 0
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_extend_appends_after_existing_shards(tmpdir):
+    store = Shard_Store(str(tmpdir), shard_size=4, dtype='uint8')
+    store.extend(images(5))
+    store.extend(images(2, 'other'))
+    assert store.shards == 3
+    assert store.sources == ['source', 'other']
+    assert [row[1] for row in store.manifest] == [0] * 4 + [1] + [2] * 2
@@ -0,0 +1,42 @@
+"""Check that commands which neither train nor download start light.
+
+Each command runs in a fresh interpreter with benchmark.bench_startup, which
+reports the modules of benchmark.heavy_modules that were imported.
+"""
+import sys
+import time
+import subprocess
+from deepsix import benchmark
+
+
+def test_help_starts_quickly():
+    # best of three, against an interpreter that does nothing, so that the
+    # bound only fails on a heavy import and not on a busy machine
+    baseline, seconds = [], []
+    for _ in range(3):
+        start_time = time.time()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        baseline.append(time.time() - start_time)
+        seconds.append(benchmark.bench_startup(['--help'])['seconds'])
+    assert min(seconds) < min(baseline) + 1.
+
+
+def test_help_imports_no_heavy_modules():
+    result = benchmark.bench_startup(['--help'])
+    assert result['heavy_modules'] == []
+
+
+def test_dataset_imports_no_heavy_modules(tmpdir):
+    source = str(tmpdir.join('source'))
+    benchmark.synthetic_images(source, 4, size=16)
+    result = benchmark.bench_startup(
+        ['dataset', str(tmpdir.join('data')), source, '--processes', '1'])
+    assert result['heavy_modules'] == []
+
+
+def test_versions_imports_no_heavy_modules(tmpdir):
+    directory = str(tmpdir.join('images'))
+    benchmark.synthetic_images(directory + '/raw', 4, size=16)
+    result = benchmark.bench_startup(
+        ['versions', directory, '--size', '8', '--processes', '1'])
+    assert result['heavy_modules'] == []